@@ -1,8 +1,10 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, Float, DateTime
+from sqlalchemy import Column, Integer, String, Text, Float, DateTime, LargeBinary, bindparam, select
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DBAPIError
 import os
 import logging
 
@@ -10,10 +12,31 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_async_engine(
+    DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1),
+    pool_recycle=1800,
+    pool_size=20,
+    max_overflow=0,
+    # Keep parameter-aware planning for the prepared UPSERT instead of switching to a generic plan.
+    connect_args={"server_settings": {"plan_cache_mode": "force_custom_plan"}},
+)
+AsyncSessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
+class HexDigest(TypeDecorator):
+    """
+    Stores a hex-encoded digest as raw bytes (bytea) while exposing it as a hex string,
+    halving the size of the column and its index compared to storing the hex text.
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return bytes.fromhex(value) if value is not None else None
+
+    def process_result_value(self, value, dialect):
+        return value.hex() if value is not None else None
+
 class LedgerEntry(Base):
     """
     Represents a single entry in the ledger.
@@ -28,7 +51,7 @@ class LedgerEntry(Base):
         ttype: Type of transaction, either "Debit" or "Credit".
         referenceid: Unique reference ID for the transaction.
         label: Category of the transaction (e.g., Meals & Entertainment, Transport).
-        fingerprint: Unique fingerprint for the entry, used to prevent duplicates.
+        fingerprint: Unique fingerprint for the entry, used to prevent duplicates (stored as 32 raw bytes).
         created_at: Timestamp when the entry was created.
     """
     __tablename__ = "ledger"
@@ -41,34 +64,80 @@ class LedgerEntry(Base):
     ttype = Column(String)
     referenceid = Column(String)
     label = Column(String)
-    fingerprint = Column(String, nullable=False, index=True, unique=True)
+    fingerprint = Column(HexDigest(32), nullable=False, index=True, unique=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
-def save_entry(data: dict):
-    db = SessionLocal()
+UPSERT_COLUMNS = ["text", "date", "amount", "currency", "vendor", "ttype", "referenceid", "label", "fingerprint"]
+
+# Built once so SQLAlchemy's compiled cache and asyncpg's prepared statement are reused on every save.
+_UPSERT_STMT = insert(LedgerEntry).values({c: bindparam(c) for c in UPSERT_COLUMNS})
+_UPSERT_STMT = _UPSERT_STMT.on_conflict_do_update(
+    index_elements=["fingerprint"],  # Unique constraint
+    set_={c: _UPSERT_STMT.excluded[c] for c in UPSERT_COLUMNS if c != "fingerprint"}  # Don't update fingerprint
+)
+
+async def _execute_upsert(rows: list[dict]) -> None:
+    async with AsyncSessionLocal() as db:
+        try:
+            await db.execute(_UPSERT_STMT, rows)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+
+async def save_entries(rows: list[dict]) -> None:
+    """
+    Upsert a batch of ledger entries with one executemany of the cached statement and commit.
+    Connections are not pinged on checkout; if a pooled connection turns out to be stale,
+    the pool is disposed and the upsert is retried once.
+
+    Args:
+        rows (list[dict]): Ledger entry dictionaries with every key in UPSERT_COLUMNS.
+    """
+    if not rows:
+        return
+
     try:
-        stmt = insert(LedgerEntry).values(**data)
-        update_dict = data.copy()
-        del update_dict["fingerprint"]  # Don't update fingerprint
-
-        stmt = stmt.on_conflict_do_update(
-            index_elements=["fingerprint"],  # Unique constraint
-            set_=update_dict
-        )
-
-        db.execute(stmt)
-        db.commit()
-        logging.info("Entry upserted (inserted or updated) successfully.")
+        try:
+            await _execute_upsert(rows)
+        except DBAPIError as e:
+            if not e.connection_invalidated:
+                raise
+            logging.warning("Stale database connection, retrying upsert once")
+            await engine.dispose()
+            await _execute_upsert(rows)
+        logging.info("%d entries upserted (inserted or updated) successfully.", len(rows))
     except Exception:
-        db.rollback()
-        logging.exception("Failed to upsert entry")
+        logging.exception("Failed to upsert entries")
         raise
-    finally:
-        db.close()
 
-# IF local DB
+async def save_entry(data: dict):
+    await save_entries([data])
+
+async def find_saved_fingerprints(fingerprints: list[str]) -> set[str]:
+    """
+    Return which of the given fingerprints already have a ledger entry.
 
-# Base.metadata.create_all(bind=engine)
+    Args:
+        fingerprints (list[str]): Hex fingerprints to look up.
+    Returns:
+        set[str]: The fingerprints found in the ledger.
+    """
+    if not fingerprints:
+        return set()
+    async with AsyncSessionLocal() as db:
+        rows = await db.execute(select(LedgerEntry.fingerprint).where(LedgerEntry.fingerprint.in_(fingerprints)))
+        return set(rows.scalars())
+
+async def init_db() -> None:
+    """
+    Create the ledger tables if they do not exist yet.
+    Run once at deploy time (scripts/init_db.py) rather than on every import.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+# IF local DB
 
 # def save_entry(data):
 #     """
@@ -90,13 +159,6 @@ def save_entry(data: dict):
 #     try:
 #         logging.info("Attempting to save entry: %s", data)
 
-#         # Print all existing rows
-#         existing_rows = db.query(LedgerEntry).all()
-#         logging.info("Current rows in DB (%d):", len(existing_rows))
-#         for row in existing_rows:
-#             logging.info("Row ID %s | Fingerprint: %s | Vendor: %s | Amount: %.2f | Date: %s",
-#                         row.id, row.fingerprint, row.vendor, row.amount, row.date)
-
 #         # Attempt to insert
 #         entry = LedgerEntry(
 #             text=data["text"],
@@ -1,19 +1,24 @@
-import imaplib
+import asyncio
 import email
 from email.header import decode_header
 from email.utils import parsedate_to_datetime
 import time
-import requests
+import orjson
+import httpx
 import os
 import hashlib
+import xxhash
 import unicodedata
-import re
-import tempfile
+import signal
 import logging
-import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from cachetools import TTLCache
+from imapclient import IMAPClient
 
-from fastapi_app.redis_publisher import RedisLogHandler
+from fastapi_app.db import save_entries, find_saved_fingerprints
+from fastapi_app.redis_publisher import (
+    create_log_handler, publish_entry_once, redis_conn, async_redis_conn, async_redis_pubsub_conn, async_claim_script,
+    CLAIM_TTL_SECONDS, CACHE_TTL_SECONDS,
+)
 
 IMAP_SERVER = os.getenv("IMAP_SERVER")
 EMAIL_ACCOUNT = os.getenv("EMAIL_ACCOUNT")
@@ -22,15 +27,37 @@ EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 FASTAPI_CLASSIFY_URL = os.getenv("FASTAPI_CLASSIFY_URL", "http://fastapi:8000/classify/")
 FASTAPI_OCR_URL = os.getenv("FASTAPI_OCR_URL", "http://fastapi:8000/ocr_result/")
 FASTAPI_OCR_SUBMIT_URL = os.getenv("FASTAPI_OCR_SUBMIT_URL", "http://fastapi:8000/ocr_document/")
-FASTAPI_REDIS_CACHE_URL = os.getenv("FASTAPI_REDIS_CACHE_URL", "http://fastapi:8000/redis_cache/")
-FASTAPI_REDIS_CLAIM_URL = os.getenv("FASTAPI_REDIS_CHECK_URL", "http://fastapi:8000/redis_claim/")
-
-processing_emails = set()
-processing_lock = threading.Lock()
+FASTAPI_REDIS_CLAIM_BATCH_URL = os.getenv("FASTAPI_REDIS_CLAIM_BATCH_URL", "http://fastapi:8000/redis_claim_batch/")
+
+SENDER = "finops@earlybirdapp.co"
+FETCH_BATCH_SIZE = 50
+OCR_WAIT_TIMEOUT_SECONDS = 60
+MAX_EMAIL_ATTEMPTS = 3  # Passes an email may fail in before last_uid moves past it anyway
+IDLE_CHECK_SECONDS = 540  # Re-issue IDLE well before servers drop idle clients
+IDLE_RECONNECT_SECONDS = 29 * 60  # RFC 2177: clients should not stay in IDLE longer than 29 minutes
+
+HTTP_TIMEOUT_SECONDS = 120  # Classification makes several LLM calls behind one request
+HTTP_MAX_CONNECTIONS = 64
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "3"))  # Same setting as the API's OCR process pool
+MAX_CONCURRENT_EMAILS = 16
+
+# Fingerprints in flight; entries expire so a skipped remove_processing_mark cannot leak memory.
+# Only touched from the event loop, so no lock is needed.
+processing_emails = TTLCache(maxsize=100_000, ttl=3600)
+# OCR jobs running in this listener, by attachment fingerprint, so duplicate attachments share one job.
+ocr_in_flight: dict[str, asyncio.Task] = {}
+# Bound the OCR jobs submitted at once to what the API's OCR pool can run, so queued jobs don't
+# burn their OCR_WAIT_TIMEOUT_SECONDS before they start; and bound the emails worked on at once,
+# so a large backlog (e.g. the first start) is processed in waves rather than all together.
+ocr_slots = asyncio.Semaphore(OCR_WORKERS)
+email_slots = asyncio.Semaphore(MAX_CONCURRENT_EMAILS)
+last_uid = 0  # Highest IMAP UID up to which every email has been handled (saved, skipped or given up on)
+failed_attempts: dict[int, int] = {}  # Failed passes per UID above last_uid
+uid_validity = None  # UIDVALIDITY of the inbox that last_uid refers to
 
 def setup_logging():
     formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
-    redis_handler = RedisLogHandler()
+    redis_handler = create_log_handler()
     redis_handler.setFormatter(formatter)
 
     logger = logging.getLogger()
@@ -56,14 +83,19 @@ def decode_str(s) -> str:
 def normalize_text(text: str) -> str:
     if not text:
         return ""
-    text = text.strip().lower()
-    text = unicodedata.normalize("NFC", text)
-    text = re.sub(r"\s+", " ", text)
-    return text
-
-def compute_fingerprint(*args) -> str:
+    text = text.lower()
+    # NFC is a no-op on ASCII, which most email bodies are.
+    if not text.isascii():
+        text = unicodedata.normalize("NFC", text)
+    # split() drops leading/trailing whitespace and splits on the same characters as \s+.
+    return " ".join(text.split())
+
+def compute_email_fingerprint(*args) -> str:
     """
     Compute a SHA-256 fingerprint for the given input strings.
+    This is the ledger's deduplication key, so it keeps a cryptographic hash.
+    Strings are normalized before hashing; bytes are hashed as-is,
+    streamed into the hasher without decoding or copying.
 
     Args:
         *args: Variable length argument list of strings or bytes to include in the fingerprint.
@@ -71,150 +103,337 @@ def compute_fingerprint(*args) -> str:
     Returns:
         str: The computed SHA-256 fingerprint as a hexadecimal string.
     """
-    normalized_parts = []
-    for a in args:
+    # hashlib's sha256 is OpenSSL's, which already uses the SHA-NI instructions where available.
+    hasher = hashlib.sha256()
+    for i, a in enumerate(args):
+        if i:
+            hasher.update(b"\x1f")
         if isinstance(a, bytes):
-            s = a.decode("utf-8", errors="ignore")
+            hasher.update(memoryview(a))
         else:
-            s = a or ""
+            hasher.update(normalize_text(a).encode("utf-8"))
+    return hasher.hexdigest()
+
+def compute_attachment_fingerprint(part: email.message.Message) -> str:
+    """
+    Compute the OCR cache key for an attachment part with XXH3-128.
+    The still-encoded payload is hashed (with its transfer encoding), so the key is known
+    before anything is decoded and cached attachments are never base64-decoded at all.
+    The key only deduplicates OCR work on our own attachments, so a fast
+    non-cryptographic hash is enough.
+
+    Args:
+        part (email.message.Message): The attachment part.
+    Returns:
+        str: The 128-bit digest as a hexadecimal string.
+    """
+    hasher = xxhash.xxh3_128(str(part.get("Content-Transfer-Encoding", "")).strip().lower().encode())
+    hasher.update(b"\x1f")
+    hasher.update(part.get_payload().encode("utf-8", "surrogateescape"))
+    return hasher.hexdigest()
+
+def create_http_client() -> httpx.AsyncClient:
+    """
+    Create the shared keep-alive client used for every call to the FastAPI service.
+    """
+    return httpx.AsyncClient(
+        timeout=HTTP_TIMEOUT_SECONDS,
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS),
+        transport=httpx.AsyncHTTPTransport(retries=3),
+    )
+
+async def claim_new_fingerprints(client: httpx.AsyncClient, fingerprints: list[str]) -> set[str]:
+    """
+    Claim a batch of email fingerprints in one request and mark the claimed ones as processing.
+    Fingerprints already in flight in this listener are filtered out first.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        fingerprints (list[str]): Email fingerprints found in this fetch pass.
+    Returns:
+        set[str]: The fingerprints this caller now owns and should process.
+    """
+    candidates = [fp for fp in fingerprints if fp not in processing_emails]
+    if not candidates:
+        return set()
 
-        normalized = normalize_text(s)
-        normalized_parts.append(normalized)
+    claim_resp = await client.post(FASTAPI_REDIS_CLAIM_BATCH_URL, json={"fingerprints": candidates}, timeout=2)
+    claim_resp.raise_for_status()
+    claimed = {fp for fp, ok in zip(candidates, claim_resp.json()["claimed"]) if ok and fp not in processing_emails}
 
-    combined = "\x1f".join(normalized_parts).encode("utf-8")
-    return hashlib.sha256(combined).hexdigest()
+    processing_emails.update(dict.fromkeys(claimed, True))
+    return claimed
 
 def remove_processing_mark(fingerprint: str) -> None:
     """
     Remove the processing mark for a given email fingerprint.
     """
-    with processing_lock:
-        processing_emails.discard(fingerprint)
+    processing_emails.pop(fingerprint, None)
 
-def extract_attachments(msg: email.message.EmailMessage) -> list[dict]:
+async def extract_attachments(parts: list[email.message.Message]) -> list[dict]:
     """
-    Extract attachments from an email message.
+    Prepare the attachment parts collected by parse_message for OCR.
+    Every part is fingerprinted first and the OCR cache is checked with one MGET;
+    only attachments without cached text have their payload decoded.
 
     Args:
-        msg (email.message.EmailMessage): The email message object.
+        parts (list): The attachment parts of an email message.
     Returns:
-        list: A list of dictionaries containing attachment filenames and their content.
+        list: A list of dictionaries with each attachment's filename and fingerprint,
+              plus either its cached "text" or its decoded "content".
     """
+    candidates = []
+    for part in parts:
+        # Attached messages (message/rfc822, e.g. a forwarded .eml) carry a list of sub-messages,
+        # not an encoded payload; there is nothing to OCR in them.
+        if part.is_multipart() or not isinstance(part.get_payload(), str):
+            continue
+        filename = decode_str(part.get_filename())
+        if filename:
+            candidates.append((filename, part, compute_attachment_fingerprint(part)))
+    if not candidates:
+        return []
+
+    cached_texts = await async_redis_conn.mget([f"ocr:text:{fp}" for *_, fp in candidates])
+
     attachments = []
-    for part in msg.walk():
-        if part.get_content_maintype() == "multipart":
+    for (filename, part, fingerprint), cached in zip(candidates, cached_texts):
+        if cached is not None:
+            attachments.append({"filename": filename, "fingerprint": fingerprint, "text": cached.decode()})
             continue
-        if "attachment" in str(part.get("Content-Disposition", "")).lower():
-            filename = decode_str(part.get_filename())
-            content = part.get_payload(decode=True)
-            if filename and content:
-                attachments.append({"filename": filename, "content": content})
+        content = part.get_payload(decode=True)
+        if content:
+            attachments.append({"filename": filename, "fingerprint": fingerprint, "content": content})
     logging.debug(f"Extracted {len(attachments)} attachments.")
     return attachments
 
-def submit_ocr(attachment: dict) -> str:
-    fingerprint = compute_fingerprint(attachment["content"])
-    claim_resp = requests.post(FASTAPI_REDIS_CLAIM_URL, json={"fingerprint": fingerprint})
-    if claim_resp.status_code != 200:
-        logging.warning(f"Failed to claim fingerprint {fingerprint}")
-        return ""
-
-    claim_data = claim_resp.json()
-    if not claim_data.get("claimed"):
-        logging.info(f"Fingerprint {fingerprint} already claimed or processed.")
-        cached_text = claim_data.get("cached_text", "")
-        return cached_text
-
-    files = {"file": (attachment["filename"], attachment["content"])}
-    submit_resp = requests.post(FASTAPI_OCR_SUBMIT_URL, files=files)
-    if not submit_resp.ok:
-        logging.warning(f"OCR submission failed for {attachment['filename']}: {submit_resp.text}")
-        return ""
-
-    task_id = submit_resp.json().get("task_id")
-    logging.info(f"OCR task submitted for {attachment['filename']} (Task ID: {task_id})")
-
-    for _ in range(60):
-        result_resp = requests.get(f"{FASTAPI_OCR_URL}{task_id}")
-        if result_resp.ok:
-            status = result_resp.json().get("status")
-            if status == "completed":
-                text = result_resp.json().get("text", "")
-                cache_resp = requests.post(FASTAPI_REDIS_CACHE_URL, json={"fingerprint": fingerprint, "text": text})
-                if cache_resp.status_code != 200:
-                    logging.warning(f"Failed to cache OCR text for fingerprint {fingerprint}")
-                return text
-            elif status == "failed":
-                logging.warning(f"OCR failed for {attachment['filename']}")
-                return ""
-        time.sleep(1)
-
-    logging.warning(f"OCR timed out for {attachment['filename']}")
-    return ""
+async def cache_ocr_text(fingerprint: str, text: str) -> None:
+    """
+    Cache the OCR text for an attachment fingerprint and release its claim in one round-trip.
+    """
+    try:
+        async with async_redis_conn.pipeline(transaction=False) as pipe:
+            pipe.set(f"ocr:text:{fingerprint}", text, ex=CACHE_TTL_SECONDS)
+            pipe.delete(f"ocr:claim:{fingerprint}")
+            await pipe.execute()
+    except Exception as e:
+        logging.warning(f"Failed to cache OCR text for fingerprint {fingerprint}: {e}")
 
+async def submit_ocr(client: httpx.AsyncClient, attachment: dict) -> str:
+    """
+    OCR an attachment through the FastAPI service, reusing cached text when the same
+    content was already processed. Concurrent requests for the same attachment
+    (e.g. one file forwarded in several emails) await a single shared OCR job.
 
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        attachment (dict): An attachment prepared by extract_attachments.
+    Returns:
+        str: The extracted text, or an empty string if OCR failed or timed out.
+    """
+    if "text" in attachment:
+        logging.info(f"Using cached OCR text for {attachment['filename']}")
+        return attachment["text"]
+
+    fingerprint = attachment["fingerprint"]
+    task = ocr_in_flight.get(fingerprint)
+    if task is None:
+        task = asyncio.create_task(run_ocr(client, attachment))
+        ocr_in_flight[fingerprint] = task
+        task.add_done_callback(lambda _: ocr_in_flight.pop(fingerprint, None))
+    # Shielded so one cancelled waiter does not cancel the job for the others.
+    return await asyncio.shield(task)
+
+async def run_ocr(client: httpx.AsyncClient, attachment: dict) -> str:
+    """
+    Claim an attachment's fingerprint, submit it for OCR and wait for the result,
+    caching the text on success.
 
-def get_email_body(msg: email.message.EmailMessage) -> str:
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        attachment (dict): An attachment with its fingerprint and decoded content.
+    Returns:
+        str: The extracted text, or an empty string if OCR failed or timed out.
     """
-    Extract the body text from an email message.
+    async with ocr_slots:
+        fingerprint = attachment["fingerprint"]
+        claimed, cached_text = await async_claim_script(
+            keys=[f"ocr:claim:{fingerprint}", f"ocr:text:{fingerprint}"], args=[CLAIM_TTL_SECONDS]
+        )
+        if not claimed:
+            logging.info(f"Fingerprint {fingerprint} already claimed or processed.")
+            return cached_text.decode()
+
+        files = {"file": (attachment["filename"], attachment["content"])}
+        submit_resp = await client.post(FASTAPI_OCR_SUBMIT_URL, files=files)
+        if not submit_resp.is_success:
+            logging.warning(f"OCR submission failed for {attachment['filename']}: {submit_resp.text}")
+            return ""
+
+        task_id = submit_resp.json().get("task_id")
+        logging.info(f"OCR task submitted for {attachment['filename']} (Task ID: {task_id})")
+
+        # Subscribe before the first status check so a completion can't slip in between;
+        # after that, only re-check the status when the OCR task announces it is done.
+        text = None
+        pubsub = async_redis_pubsub_conn.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(f"ocr:done:{task_id}")
+        try:
+            deadline = time.monotonic() + OCR_WAIT_TIMEOUT_SECONDS
+            while True:
+                result_resp = await client.get(f"{FASTAPI_OCR_URL}{task_id}")
+                if result_resp.is_success:
+                    status = result_resp.json().get("status")
+                    if status == "completed":
+                        text = result_resp.json().get("text", "")
+                        break
+                    elif status == "failed":
+                        logging.warning(f"OCR failed for {attachment['filename']}")
+                        return ""
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                await pubsub.get_message(timeout=remaining)
+        finally:
+            await pubsub.aclose()
+
+        if text is None:
+            logging.warning(f"OCR timed out for {attachment['filename']}")
+            return ""
+        # Cached only after the subscription is released, so no connection is held while waiting for another.
+        await cache_ocr_text(fingerprint, text)
+        return text
+
+def parse_message(msg: email.message.EmailMessage) -> tuple[str, list[email.message.Message]]:
+    """
+    Walk the MIME tree of an email message once, extracting the body text and
+    collecting the attachment parts. Attachment payloads are left encoded so they
+    are only decoded (by extract_attachments) for emails that will be processed.
 
     Args:
         msg (email.message.EmailMessage): The email message object.
     Returns:
-        str: The plain text body of the email, or an empty string if not found.
+        tuple: The plain text body of the email (or an empty string if not found),
+               and the list of attachment parts.
     """
-    if msg.is_multipart():
-        for part in msg.walk():
-            if part.get_content_type() == "text/plain" and "attachment" not in str(part.get("Content-Disposition", "")):
-                try:
-                    return part.get_payload(decode=True).decode()
-                except Exception:
-                    continue
-    else:
+    if not msg.is_multipart():
         try:
-            return msg.get_payload(decode=True).decode()
+            return msg.get_payload(decode=True).decode(), []
         except Exception:
-            pass
-    return ""
+            return "", []
+
+    body = None
+    attachment_parts = []
+    for part in msg.walk():
+        if part.get_content_maintype() == "multipart":
+            continue
+        if "attachment" in str(part.get("Content-Disposition", "")).lower():
+            attachment_parts.append(part)
+        elif body is None and part.get_content_type() == "text/plain":
+            try:
+                body = part.get_payload(decode=True).decode()
+            except Exception:
+                continue
+    return body or "", attachment_parts
 
-def fetch_emails() -> list[dict]:
+def connect_imap() -> IMAPClient:
     """
-    Fetch emails from the IMAP server.
-    This function connects to the IMAP server, searches for emails from a specific sender,
-    and processes each email to extract relevant information such as subject, date, body,
-    attachments, and computes a fingerprint for each email.
+    Open an authenticated IMAP connection with the inbox selected.
+    If the inbox's UIDVALIDITY changed since the last connection (or on startup), the last
+    fetched UID is reloaded from Redis for the new UIDVALIDITY, so restarts resume where
+    the previous run stopped instead of rescanning the whole inbox.
 
     Returns:
-        list: A list of dictionaries containing email data including subject, date, body,
-                attachments, and fingerprint.
+        IMAPClient: The connected client.
     """
+    global last_uid, uid_validity
     logging.info("Connecting to IMAP...")
-    mail = imaplib.IMAP4_SSL(IMAP_SERVER)
+    mail = IMAPClient(IMAP_SERVER, ssl=True)
     mail.login(EMAIL_ACCOUNT, EMAIL_PASSWORD)
-    mail.select("inbox")
-    result, data = mail.search(None, 'FROM', 'finops@earlybirdapp.co')
-    email_ids = data[0].split()
-    logging.debug(f"Found {len(email_ids)} emails from finops@earlybirdapp.co")
+    folder = mail.select_folder("INBOX")
+    if folder[b"UIDVALIDITY"] != uid_validity:
+        uid_validity = folder[b"UIDVALIDITY"]
+        last_uid = int(redis_conn.get(f"imap:last_uid:{uid_validity}") or 0)
+        failed_attempts.clear()
+    return mail
+
+def read_new_messages(mail: IMAPClient) -> tuple[list[int], list[tuple]]:
+    """
+    Search the open connection for emails from a specific sender that arrived after the
+    last fetched UID, and parse each one into subject, date, body, attachment parts and fingerprint.
+    Messages are fetched with BODY.PEEK, FETCH_BATCH_SIZE UIDs per FETCH command,
+    so their \\Seen flag is left untouched. This is blocking IMAP I/O.
+
+    Args:
+        mail (IMAPClient): A connected client with the inbox selected.
+    Returns:
+        tuple: The new UIDs, and a list of
+               (uid, attachment_parts, subject, date, body, fingerprint) tuples.
+    """
+    # "N:*" always matches the highest UID in the mailbox, even when it is below N.
+    email_ids = [uid for uid in mail.search(["UID", f"{last_uid + 1}:*", "FROM", SENDER]) if uid > last_uid]
+    logging.debug(f"Found {len(email_ids)} new emails from {SENDER}")
+
+    parsed = []
+    for i in range(0, len(email_ids), FETCH_BATCH_SIZE):
+        batch = email_ids[i:i + FETCH_BATCH_SIZE]
+        fetched = mail.fetch(batch, ["BODY.PEEK[]"])
+        for e_id in batch:
+            try:
+                msg = email.message_from_bytes(fetched[e_id][b"BODY[]"])
+
+                subject = decode_str(msg.get("Subject", ""))
+                raw_date = msg.get("Date", "")
+                date_str = parsedate_to_datetime(raw_date).strftime("%Y-%m-%d") if raw_date else time.strftime("%Y-%m-%d")
+                body, attachment_parts = parse_message(msg)
+
+                fingerprint = compute_email_fingerprint(subject, body)
+                parsed.append((e_id, attachment_parts, subject, date_str, body, fingerprint))
+            except Exception as e:
+                logging.error(f"Error fetching email {e_id}: {e}")
+    return email_ids, parsed
+
+async def fetch_emails(mail: IMAPClient, client: httpx.AsyncClient) -> tuple[list[int], list[dict], set[int], set[int]]:
+    """
+    Fetch emails from the IMAP server.
+    This function reads new emails (in a worker thread), claims their fingerprints,
+    and returns the claimed ones with their attachments decoded.
+
+    Args:
+        mail (IMAPClient): A connected client with the inbox selected.
+        client (httpx.AsyncClient): The shared HTTP client.
+    Returns:
+        tuple: All new UIDs found; a list of dictionaries containing email data including uid,
+               subject, date, body, attachments, and fingerprint; the UIDs of claimed
+               emails whose attachments could not be read; and the UIDs of emails claimed
+               elsewhere (or by a run that died) that are not in the ledger yet.
+    """
+    email_ids, parsed = await asyncio.to_thread(read_new_messages, mail)
+
+    claimed = await claim_new_fingerprints(client, [fingerprint for *_, fingerprint in parsed])
+
+    # A held claim only means someone started on the email; the ledger says whether it was saved.
+    # Unsaved ones hold last_uid back until they are, or until their claim expires and they are retried.
+    skipped = {fingerprint for *_, fingerprint in parsed if fingerprint not in claimed}
+    saved = await find_saved_fingerprints(list(skipped))
 
     emails = []
-    for e_id in email_ids:
-        try:
-            _, msg_data = mail.fetch(e_id, "(RFC822)")
-            msg = email.message_from_bytes(msg_data[0][1])
-
-            subject = decode_str(msg.get("Subject", ""))
-            raw_date = msg.get("Date", "")
-            date_str = parsedate_to_datetime(raw_date).strftime("%Y-%m-%d") if raw_date else time.strftime("%Y-%m-%d")
-            body = get_email_body(msg)
-
-            fingerprint = compute_fingerprint(subject, body)
-            claim_resp = requests.post(FASTAPI_REDIS_CLAIM_URL, json={"fingerprint": fingerprint})
-            if claim_resp.status_code != 200:
-                logging.info(f"Skipping already processed/processing email: {subject} ({fingerprint[:8]}...)")
-                continue
+    failed = set()
+    pending = set()
+    for e_id, attachment_parts, subject, date_str, body, fingerprint in parsed:
+        if fingerprint not in claimed:
+            if fingerprint in saved:
+                logging.info(f"Skipping already processed email: {subject} ({fingerprint[:8]}...)")
+            else:
+                logging.info(f"Skipping email still being processed: {subject} ({fingerprint[:8]}...)")
+                pending.add(e_id)
+            continue
+        claimed.discard(fingerprint)
 
-            attachments = extract_attachments(msg)
+        try:
+            attachments = await extract_attachments(attachment_parts)
             emails.append({
+                "uid": e_id,
                 "subject": subject,
                 "date": date_str,
                 "body": body,
@@ -222,70 +441,190 @@ def fetch_emails() -> list[dict]:
                 "fingerprint": fingerprint
             })
         except Exception as e:
-            logging.error(f"Error fetching email {e_id}: {e}")
-    mail.logout()
-    logging.info("IMAP disconnected.")
-    return emails
+            remove_processing_mark(fingerprint)
+            await release_email_claims([fingerprint])
+            failed.add(e_id)
+            logging.error(f"Error reading attachments of email {e_id}: {e}")
+    return email_ids, emails, failed, pending
+
+async def release_email_claims(fingerprints: list[str]) -> None:
+    """
+    Drop the claims on emails that failed (or are abandoned on shutdown), so the next pass
+    can claim and retry them instead of skipping them as still being processed.
+    """
+    if not fingerprints:
+        return
+    try:
+        await async_redis_conn.delete(*(f"ocr:claim:{fp}" for fp in fingerprints))
+    except Exception as e:
+        logging.warning(f"Failed to release claims of {len(fingerprints)} emails: {e}")
+
+async def advance_last_uid(email_ids: list[int], failed: set[int], pending: set[int]) -> None:
+    """
+    Move last_uid up to just below the oldest failed or pending email, persisting it in Redis, so
+    those emails (and everything after them) are fetched again on the next pass. An email that has
+    failed MAX_EMAIL_ATTEMPTS passes is given up on, so it cannot hold the inbox back forever;
+    pending emails are not failures and hold last_uid back until they are saved.
+
+    Args:
+        email_ids (list[int]): Every new UID found in this pass.
+        failed (set[int]): The UIDs this pass processed but did not save.
+        pending (set[int]): The UIDs skipped because of a held claim, with no ledger entry yet.
+    """
+    global last_uid
+    if not email_ids:
+        return
+    retry = set()
+    for uid in failed:
+        failed_attempts[uid] = failed_attempts.get(uid, 0) + 1
+        if failed_attempts[uid] < MAX_EMAIL_ATTEMPTS:
+            retry.add(uid)
+        else:
+            logging.error(f"Giving up on email {uid} after {MAX_EMAIL_ATTEMPTS} failed attempts")
+
+    retry |= pending
+    new_last_uid = min(retry) - 1 if retry else max(email_ids)
+    if new_last_uid > last_uid:
+        last_uid = new_last_uid
+        for uid in [uid for uid in failed_attempts if uid <= last_uid]:
+            del failed_attempts[uid]
+        await async_redis_conn.set(f"imap:last_uid:{uid_validity}", last_uid)
 
-def process_email(email_data: dict) -> None:
+async def process_email(client: httpx.AsyncClient, email_data: dict) -> dict | None:
     """
     Process the email data by performing OCR on attachments and classifying the email content.
     This function extracts the subject, body, and attachments from the email,
-    submits attachments for OCR processing, combines the results with the email body,
+    submits attachments for OCR processing concurrently, combines the results with the email body,
     and sends the combined text to a FastAPI endpoint for classification.
+    The classified entry is returned rather than saved, so the caller can upsert
+    a whole batch of entries at once.
 
     Args:
+        client (httpx.AsyncClient): The shared HTTP client.
         email_data (dict): A dictionary containing email data including subject, date, body,
                            attachments, and fingerprint.
+    Returns:
+        dict | None: The classified ledger entry, or None if processing failed.
     """
     fingerprint = email_data["fingerprint"]
     try:
-        ocr_texts = []
-        if email_data["attachments"]:
-            with ThreadPoolExecutor(max_workers=3) as exec_:
-                futures = [exec_.submit(submit_ocr, att) for att in email_data["attachments"]]
-                for f in as_completed(futures):
-                    text = f.result()
-                    if text:
-                        ocr_texts.append(text)
-
-        combined_text = f"{email_data['subject']}\n{email_data['body']}\n\nAttachments OCR:\n" + "\n\n".join(ocr_texts)
-
-        resp = requests.post(FASTAPI_CLASSIFY_URL, json={
-            "text": combined_text,
-            "date": email_data["date"],
-            "fingerprint": fingerprint,
-        })
-        if resp.ok:
-            logging.info(f"Classification success: {resp.json()}")
-        else:
-            logging.error(f"Classification failed: {resp.text}")
+        async with email_slots:
+            ocr_results = await asyncio.gather(*(submit_ocr(client, att) for att in email_data["attachments"]))
+            ocr_texts = [text for text in ocr_results if text]
+
+            combined_text = "\n".join([
+                email_data["subject"],
+                email_data["body"],
+                "",
+                "Attachments OCR:",
+                "\n\n".join(ocr_texts),
+            ])
+
+            resp = await client.post(FASTAPI_CLASSIFY_URL, content=orjson.dumps({
+                "text": combined_text,
+                "date": email_data["date"],
+                "fingerprint": fingerprint,
+                "persist": False,
+            }), headers={"Content-Type": "application/json"})
+        if resp.is_success:
+            entry = resp.json()
+            # The /classify/ response model has no fingerprint field; the upsert needs it.
+            entry["fingerprint"] = fingerprint
+            logging.info(f"Classification success: {entry}")
+            return entry
+        logging.error(f"Classification failed: {resp.text}")
     except Exception as e:
         logging.exception(f"Failed processing email {fingerprint[:8]}...")
     finally:
         remove_processing_mark(fingerprint)
+    return None
+
+async def process_new_emails(mail: IMAPClient, client: httpx.AsyncClient) -> None:
+    """
+    Fetch new emails, process them concurrently, and upsert the classified entries in a single batch.
+    last_uid only advances past emails once their entries are saved; failed ones are fetched again.
+
+    Args:
+        mail (IMAPClient): A connected client with the inbox selected.
+        client (httpx.AsyncClient): The shared HTTP client.
+    """
+    email_ids, new_emails, failed, pending = await fetch_emails(mail, client)
+    if new_emails:
+        logging.info(f"Processing {len(new_emails)} new emails")
+        results = await asyncio.gather(*(process_email(client, email_data) for email_data in new_emails))
+        entries = [entry for entry in results if entry]
+        try:
+            await save_entries(entries)
+            unsaved = [email_data for email_data, entry in zip(new_emails, results) if not entry]
+            # /classify/ was called with persist=False, so the entries are announced only once stored.
+            published = await asyncio.gather(*(publish_entry_once(entry) for entry in entries), return_exceptions=True)
+            for entry, result in zip(entries, published):
+                if isinstance(result, Exception):
+                    logging.warning(f"Failed to publish ledger update for {entry['fingerprint'][:8]}: {result}")
+        except Exception:
+            logging.exception(f"Failed to save {len(new_emails)} processed emails")
+            unsaved = new_emails
+        failed.update(email_data["uid"] for email_data in unsaved)
+        await release_email_claims([email_data["fingerprint"] for email_data in unsaved])
+    else:
+        logging.debug("No new emails found")
+    # Only now that the entries are saved may last_uid move past them.
+    await advance_last_uid(email_ids, failed, pending)
 
-def main_loop() -> None:
+def wait_for_new_mail(mail: IMAPClient) -> bool:
+    """
+    Block in IMAP IDLE until the server pushes a notification or IDLE_CHECK_SECONDS pass.
+
+    Args:
+        mail (IMAPClient): A connected client with the inbox selected.
+    Returns:
+        bool: True if the server reported new messages (EXISTS).
+    """
+    mail.idle()
+    try:
+        responses = mail.idle_check(timeout=IDLE_CHECK_SECONDS)
+    finally:
+        mail.idle_done()
+    return any(len(r) > 1 and r[1] == b"EXISTS" for r in responses)
+
+async def main_loop() -> None:
     """
     Main loop for fetching and processing emails.
-    This function continuously checks for new emails every 10 seconds,
-    fetches them, and processes each email using a thread pool to handle OCR and classification concurrently.
-    Maximum number of concurrent threads is set to 5.
+    This function keeps one IMAP connection open and waits in IDLE until the server
+    pushes an EXISTS notification, then fetches and processes the new emails. OCR and
+    classification run concurrently on the event loop over one shared HTTP client,
+    while the blocking IMAP calls run in worker threads.
+    The connection is re-established every 29 minutes, and after any error.
+    On SIGTERM (or cancellation) the claims of emails still in flight are released,
+    so a restarted listener can pick them up at once instead of after CLAIM_TTL_SECONDS.
     """
-    with ThreadPoolExecutor(max_workers=5) as executor:
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        await run_main_loop()
+    finally:
+        await release_email_claims(list(processing_emails))
+
+async def run_main_loop() -> None:
+    """
+    The body of main_loop: connect, process, IDLE, reconnect, forever.
+    """
+    async with create_http_client() as client:
         while True:
             try:
-                new_emails = fetch_emails()
-                if new_emails:
-                    logging.info(f"Processing {len(new_emails)} new emails")
-                    for email_data in new_emails:
-                        executor.submit(process_email, email_data)
-                else:
-                    logging.debug("No new emails found")
+                mail = await asyncio.to_thread(connect_imap)
+                try:
+                    connected_at = time.monotonic()
+                    await process_new_emails(mail, client)
+                    while time.monotonic() - connected_at < IDLE_RECONNECT_SECONDS:
+                        if await asyncio.to_thread(wait_for_new_mail, mail):
+                            await process_new_emails(mail, client)
+                finally:
+                    await asyncio.to_thread(mail.logout)
+                    logging.info("IMAP disconnected.")
             except Exception:
                 logging.exception("Unhandled error in main loop")
-            time.sleep(10)
+                await asyncio.sleep(10)
 
 
 if __name__ == "__main__":
-    main_loop()
\ No newline at end of file
+    asyncio.run(main_loop())
\ No newline at end of file
@@ -1,22 +1,26 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, BackgroundTasks
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, File, UploadFile, Request
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
 from fastapi.middleware.cors import CORSMiddleware
-from .nlp import classify_email_agentic
-from .db import save_entry
+from fastapi.responses import ORJSONResponse, Response
+from .nlp import classify_email_batch
+from .db import save_entry, init_db
+from .ocr import perform_ocr, create_ocr_pool
 from .redis_publisher import *
+import os
+import asyncio
 import traceback
 import uuid
+import orjson
+import xxhash
 from contextlib import asynccontextmanager
-ocr_results = {}
-
-REDIS_PROCESSED_SET = "processed_fingerprints"
 
 import time
 
 class EmailText(BaseModel):
     text: str = Field(..., min_length=1)
     date: str = Field(..., pattern=r"^\d{4}-\d{2}-\d{2}$", description="Date in YYYY-MM-DD format")
-    fingerprint: str = Field(..., description="Fingerprint for deduplication")
+    fingerprint: str = Field(..., pattern=r"^[0-9a-f]{64}$", description="Fingerprint for deduplication (hex SHA-256)")
+    persist: bool = Field(True, description="Save and publish the entry; False when the caller batches its own writes and publishes after them")
 
 class FingerprintCheck(BaseModel):
     fingerprint: str = Field(..., description="Fingerprint to check")
@@ -25,6 +29,8 @@ class ClassifiedResult(BaseModel):
     """
     Represents the result of classifying an email.
     """
+    model_config = ConfigDict(extra="ignore")
+
     text: str = Field(..., min_length=1, description="Short description of the transaction")
     date: str = Field(..., pattern=r"^\d{4}-\d{2}-\d{2}$", description="Date of the transaction in YYYY-MM-DD format")
     amount: float = Field(..., ge=0, description="Amount of the transaction")
@@ -34,14 +40,73 @@ class ClassifiedResult(BaseModel):
     referenceid: str = Field(..., description="Reference ID for the transaction")
     label: str = Field(..., description="Label for the transaction")
 
+# Built once; validates and dumps classification results on every /classify/ call.
+CLASSIFIED_ADAPTER = TypeAdapter(ClassifiedResult)
+
+def validate_classified(result: dict) -> dict:
+    """
+    Validate a classification result and return it as a plain dict of the ClassifiedResult fields.
+    """
+    return CLASSIFIED_ADAPTER.dump_python(CLASSIFIED_ADAPTER.validate_python(result))
+
+CLASSIFY_BATCH_SIZE = 8
+CLASSIFY_BATCH_WINDOW_SECONDS = 0.02
+
+# (text, date, future) items waiting to be classified; created by lifespan on the server's event loop.
+classify_queue: asyncio.Queue | None = None
+
+# Running /ocr_document/ jobs; holds a reference so the event loop does not drop them mid-flight.
+ocr_jobs: set[asyncio.Task] = set()
+
+async def run_classify_batch(batch: list[tuple]) -> None:
+    """
+    Classify one micro-batch and resolve each waiting request's future.
+    """
+    texts, dates, futures = zip(*batch)
+    try:
+        results = await classify_email_batch(list(texts), list(dates), validate=validate_classified)
+    except Exception as e:
+        results = [e] * len(futures)
+    for future, result in zip(futures, results):
+        if future.done():
+            continue
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+async def classify_batcher(queue: asyncio.Queue) -> None:
+    """
+    Collect /classify/ requests for up to CLASSIFY_BATCH_WINDOW_SECONDS (or CLASSIFY_BATCH_SIZE
+    requests) and hand them to the workflow as one batch. Batches run as their own tasks so the
+    next window opens while earlier batches are still waiting on the LLM.
+    """
+    loop = asyncio.get_running_loop()
+    pending = set()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + CLASSIFY_BATCH_WINDOW_SECONDS
+        while len(batch) < CLASSIFY_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        task = asyncio.create_task(run_classify_batch(batch))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
     Startup and shutdown events for the FastAPI application.
     """
-    redis_conn.delete(REDIS_PROCESSED_SET)
+    if os.getenv("INIT_DB") == "1":
+        await init_db()
     logger = logging.getLogger(__name__)
-    handler = RedisLogHandler()
+    handler = create_log_handler()
     formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
     handler.setFormatter(formatter)
     logger.addHandler(handler)
@@ -52,9 +117,19 @@ async def lifespan(app: FastAPI):
         logger.addHandler(handler)
         logger.setLevel(logging.DEBUG)
 
+    global classify_queue
+    classify_queue = asyncio.Queue()
+    batcher = asyncio.create_task(classify_batcher(classify_queue))
+    app.state.ocr_pool = create_ocr_pool()
+
     yield
 
-app = FastAPI(lifespan=lifespan)
+    batcher.cancel()
+    for job in ocr_jobs:
+        job.cancel()
+    app.state.ocr_pool.shutdown(wait=False, cancel_futures=True)
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -64,84 +139,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-def perform_ocr(file_bytes: bytes, filename: str) -> str:
-    """
-    Function to perform OCR on a document or image file.
-    Uses PyMuPDF (fitz) to extract text from PDF or image files.
-    Supports both PDF and common image formats (PNG, JPG, JPEG).
-
-    Args:
-        file_bytes (bytes): The content of the file to process.
-        filename (str): The name of the file, used to determine its type.
-    Returns:
-        str: The extracted text from the document or image.
-    """
-    import os
-    import tempfile
-    import fitz
-
-    supported_images = [".png", ".jpg", ".jpeg"]
-    supported_pdfs = [".pdf"]
-
-    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[1]) as tmp:
-        tmp.write(file_bytes)
-        tmp_path = tmp.name
-
-    try:
-        full_text = ""
-
-        if any(filename.endswith(ext) for ext in supported_pdfs):
-            doc = fitz.open(tmp_path)
-            for page_num, page in enumerate(doc):
-                text = page.get_text().strip()
-                if not text:
-                    matrix = fitz.Matrix(2, 2)
-                    pix = page.get_pixmap(matrix=matrix)
-
-                    ocr_doc = fitz.open()
-                    ocr_page = ocr_doc.new_page(width=pix.width, height=pix.height)
-                    ocr_page.insert_image(fitz.Rect(0, 0, pix.width, pix.height), pixmap=pix)
-
-                    tp = ocr_page.get_textpage_ocr()
-                    text = ocr_page.get_text("text", textpage=tp)
-                    ocr_doc.close()
-
-                full_text += f"\n\n--- Page {page_num + 1} ---\n\n{text}"
-            doc.close()
-
-        elif any(filename.endswith(ext) for ext in supported_images):
-            img = fitz.Pixmap(tmp_path)
-            if img.alpha:
-                img = fitz.Pixmap(img, 0)
-
-            doc = fitz.open()
-            page = doc.new_page(width=img.width, height=img.height)
-            page.insert_image(fitz.Rect(0, 0, img.width, img.height), pixmap=img)
-
-            tp = page.get_textpage_ocr()
-            full_text = page.get_text("text", textpage=tp)
-            doc.close()
-
-        else:
-            raise ValueError("Unsupported file type")
-
-        return full_text.strip()
-
-    finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
-
-
 @app.get("/health/")
 def health():
     return {"status": "ok"}
 
-CLAIM_TTL_SECONDS = 600
-CACHE_TTL_SECONDS = 7 * 86400
+OCR_TASK_TTL_SECONDS = 3600  # Upper bound on how long a task may stay "processing"
+OCR_RESULT_TTL_SECONDS = 600  # Finished results are read right after the ocr:done notification
+
+async def set_ocr_task(task_id: str, ttl: int = OCR_TASK_TTL_SECONDS, **fields) -> None:
+    """
+    Store OCR task state in Redis, shared by all workers and expiring after `ttl` seconds.
+    The state is stored as the encoded JSON body that /ocr_result/ returns as-is.
+    """
+    await async_redis_conn.set(f"ocr:task:{task_id}", orjson.dumps(fields), ex=ttl)
 
 class ClaimRequest(BaseModel):
     fingerprint: str
 
+class ClaimBatchRequest(BaseModel):
+    fingerprints: list[str]
+
 class CacheRequest(BaseModel):
     fingerprint: str
     text: str
@@ -151,52 +168,81 @@ async def redis_claim(req: ClaimRequest):
     claim_key = f"ocr:claim:{req.fingerprint}"
     cache_key = f"ocr:text:{req.fingerprint}"
 
-    cached_text = redis_conn.get(cache_key)
-    if cached_text is not None:
-        return {"claimed": False, "cached_text": cached_text}
+    claimed, cached_text = await async_claim_script(keys=[claim_key, cache_key], args=[CLAIM_TTL_SECONDS])
+    return {"claimed": bool(claimed), "cached_text": cached_text}
+
+@app.post("/redis_claim_batch/")
+async def redis_claim_batch(req: ClaimBatchRequest):
+    """
+    Claim many fingerprints in a single pipelined Redis round-trip.
+
+    Args:
+        req (ClaimBatchRequest): The fingerprints to claim.
+    Returns:
+        dict: {"claimed": [...]}, one boolean per requested fingerprint, in order.
+    """
+    if not req.fingerprints:
+        return {"claimed": []}
 
-    claimed = redis_conn.set(claim_key, "claimed", nx=True, ex=CLAIM_TTL_SECONDS)
-    if not claimed:
-        return {"claimed": False, "cached_text": ""}
+    async with async_redis_conn.pipeline(transaction=False) as pipe:
+        pipe.mget([f"ocr:text:{fp}" for fp in req.fingerprints])
+        for fp in req.fingerprints:
+            pipe.set(f"ocr:claim:{fp}", "claimed", nx=True, ex=CLAIM_TTL_SECONDS)
+        cached_texts, *claims = await pipe.execute()
 
-    return {"claimed": True, "cached_text": ""}
+    return {"claimed": [bool(claimed) and cached is None for cached, claimed in zip(cached_texts, claims)]}
 
 @app.post("/redis_cache/")
 async def redis_cache(req: CacheRequest):
     claim_key = f"ocr:claim:{req.fingerprint}"
     cache_key = f"ocr:text:{req.fingerprint}"
 
-    redis_conn.set(cache_key, req.text, ex=CACHE_TTL_SECONDS)
-
-    redis_conn.delete(claim_key)
+    async with async_redis_conn.pipeline(transaction=False) as pipe:
+        pipe.set(cache_key, req.text, ex=CACHE_TTL_SECONDS)
+        pipe.delete(claim_key)
+        await pipe.execute()
 
     return {"success": True}
 
 @app.post("/ocr_document/")
-async def ocr_document(file: UploadFile = File(...), background_tasks: BackgroundTasks = BackgroundTasks()):
+async def ocr_document(request: Request, file: UploadFile = File(...)):
     """
     Perform OCR on an uploaded document file asynchronously.
+    The job starts on the event loop as soon as the task is registered; the OCR itself
+    runs in the app.state.ocr_pool processes, so neither the loop nor the threadpool is tied up.
 
     Args:
+        request (Request): The incoming request, used to reach the app's OCR pool.
         file (UploadFile): The document file to process, which can be a PDF or an image file.
-        background_tasks (BackgroundTasks): FastAPI's background task manager to handle OCR processing
-            without blocking the request.
     Returns:
         dict: A dictionary containing a unique task ID for tracking the OCR process.
     """
     try:
-        contents = file.file.read()
+        contents = await file.read()
         task_id = str(uuid.uuid4())
 
-        def background_ocr(file_bytes, filename, task_id):
+        # Identical uploads reuse the text of the first one instead of running OCR again.
+        upload_key = f"ocr:upload:{xxhash.xxh3_128_hexdigest(contents)}"
+        cached_text = await async_redis_conn.get(upload_key)
+        if cached_text is not None:
+            await set_ocr_task(task_id, ttl=OCR_RESULT_TTL_SECONDS, status="completed", text=cached_text.decode())
+            return {"task_id": task_id}
+
+        ocr_pool = request.app.state.ocr_pool
+
+        async def background_ocr(file_bytes, filename, task_id):
             try:
-                text = perform_ocr(file_bytes, filename)
-                ocr_results[task_id] = {"status": "completed", "text": text}
+                text = await perform_ocr(ocr_pool, file_bytes, filename)
+                await set_ocr_task(task_id, ttl=OCR_RESULT_TTL_SECONDS, status="completed", text=text)
+                await async_redis_conn.set(upload_key, text, ex=CACHE_TTL_SECONDS)
             except Exception as e:
-                ocr_results[task_id] = {"status": "failed", "error": str(e)}
+                await set_ocr_task(task_id, ttl=OCR_RESULT_TTL_SECONDS, status="failed", error=str(e))
+            await async_redis_conn.publish(f"ocr:done:{task_id}", "done")
 
-        ocr_results[task_id] = {"status": "processing", "text": None}
-        background_tasks.add_task(background_ocr, contents, file.filename, task_id)
+        await set_ocr_task(task_id, status="processing")
+        job = asyncio.create_task(background_ocr(contents, file.filename, task_id))
+        ocr_jobs.add(job)
+        job.add_done_callback(ocr_jobs.discard)
 
         return {"task_id": task_id}
     except Exception as e:
@@ -210,15 +256,15 @@ async def get_ocr_result(task_id: str):
     Args:
         task_id (str): The unique identifier for the OCR task.
     Returns:
-        dict: A dictionary containing the OCR result with keys:
-            - status: "completed" or "failed"
-            - text: The extracted text if successful, or None if failed.
+        Response: The stored JSON object, sent without re-encoding, with keys:
+            - status: "processing", "completed" or "failed"
+            - text: The extracted text, present once completed.
             - error: Error message if the task failed.
     """
-    result = ocr_results.get(task_id)
-    if not result:
+    result = await async_redis_conn.get(f"ocr:task:{task_id}")
+    if result is None:
         raise HTTPException(status_code=404, detail="Task ID not found")
-    return result
+    return Response(content=result, media_type="application/json")
 
 @app.post("/classify/", response_model=ClassifiedResult)
 async def classify(data: EmailText):
@@ -226,17 +272,19 @@ async def classify(data: EmailText):
     Classify the email content and extract relevant financial information.
     """   
     try:
-        result = classify_email_agentic(data.text, data.date)
-        validated = ClassifiedResult(**result)
-        entry_with_fingerprint = validated.model_dump()
-        entry_with_fingerprint["fingerprint"] = data.fingerprint
-
-        save_entry(entry_with_fingerprint)
-        publish_entry_once(entry_with_fingerprint)
+        future = asyncio.get_running_loop().create_future()
+        await classify_queue.put((data.text, data.date, future))
+        result = await future
+        # Already validated by the batch; copied so cached results are never mutated.
+        entry_with_fingerprint = {**result, "fingerprint": data.fingerprint}
+
+        # Publish only what is stored; callers that batch their own writes publish after saving.
+        if data.persist:
+            await save_entry(entry_with_fingerprint)
+            await publish_entry_once(entry_with_fingerprint)
         
         return entry_with_fingerprint
         
     except Exception as classification_error:
-        redis_conn.srem(REDIS_PROCESSED_SET, data.fingerprint)
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(classification_error))
\ No newline at end of file
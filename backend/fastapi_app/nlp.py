@@ -1,110 +1,73 @@
 from langgraph.graph import StateGraph, END
 from typing import TypedDict, Annotated
 import operator
+import asyncio
 import re
-import json
 import os
-import requests
+import logging
+import orjson
+import httpx
+import xxhash
+from cachetools import TTLCache
+
+from .redis_publisher import async_redis_conn
+
+logger = logging.getLogger(__name__)
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_MAX_CONCURRENCY = int(os.getenv("OPENROUTER_MAX_CONCURRENCY", "16"))
 MODEL_NAME = "google/gemini-2.5-flash-preview-05-20"
-
-
-def extract_json_from_text(text):
-    """Extract JSON from text that may contain explanatory content"""
-    # Try to find JSON block in the text
-    json_pattern = r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}'
-    matches = re.findall(json_pattern, text, re.DOTALL)
-    
-    for match in matches:
-        try:
-            parsed = json.loads(match)
-            return match
-        except json.JSONDecodeError:
-            continue
-    
-    raise ValueError("No valid JSON found in response")
-
-
-def call_openrouter(messages, max_retries=3):
-    headers = {
+MAX_TOKENS_PER_RESULT = 1024  # One transaction object is well under this
+# Long inputs are cut to their head (subject, vendor, header) and tail (totals, footer) before prompting.
+LLM_INPUT_HEAD_CHARS = 4000
+LLM_INPUT_TAIL_CHARS = 2000
+CLASSIFY_CACHE_TTL_SECONDS = 7 * 86400
+CLASSIFY_LOCAL_CACHE_SIZE = 2048
+CLASSIFY_LOCAL_CACHE_TTL_SECONDS = 3600
+
+# In-process tier in front of the Redis classify:<hash> keys; holds the encoded results by cache key.
+classify_local_cache = TTLCache(maxsize=CLASSIFY_LOCAL_CACHE_SIZE, ttl=CLASSIFY_LOCAL_CACHE_TTL_SECONDS)
+
+# Markdown code fences the model sometimes wraps its JSON in.
+FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.MULTILINE)
+
+# Anything a transaction could be read from: a digit, a currency symbol, or a money keyword.
+# Texts without a single match (empty OCR, plain newsletters) are answered without the LLM.
+TRANSACTION_HINT_RE = re.compile(
+    r"\d|[$€£¥]|\b(?:invoice|receipt|total|amount|paid|payment|refund|usd|sgd|idr|eur)\b", re.IGNORECASE
+)
+
+# One keep-alive HTTP/2 client for every LLM call, so requests reuse the TLS connection to OpenRouter.
+openrouter_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    headers={
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
         "Content-Type": "application/json",
         "X-Title": "Live Ledger Agent",
-    }
-    payload = {
-        "model": MODEL_NAME,
-        "messages": messages,
-        "max_tokens": 10000,
-        "temperature": 0.1,
-    }
-    
-    for attempt in range(max_retries):
-        try:
-            resp = requests.post(OPENROUTER_URL, headers=headers, json=payload, timeout=30)
-            resp.raise_for_status()
-            
-            response_data = resp.json()
-            
-            if 'choices' not in response_data or not response_data['choices']:
-                raise ValueError("No choices in response")
-            
-            content = response_data['choices'][0]['message']['content']
-            
-            if not content or not content.strip():
-                raise ValueError("Empty response content")
-            
-            content = re.sub(r"^```(?:json)?\s*|\s*```$", "", content.strip(), flags=re.MULTILINE)
-            
-            try:
-                json_content = extract_json_from_text(content)
-                json.loads(json_content)
-                return json_content
-            except (json.JSONDecodeError, ValueError) as e:
-                if attempt < max_retries - 1:
-                    print(f"JSON extraction failed, retrying... (attempt {attempt + 1}/{max_retries})")
-                    print(f"Content received: {content[:500]}...")
-                    continue
-                else:
-                    raise ValueError(f"Invalid JSON after {max_retries} attempts: {content}")
-            
-        except requests.exceptions.RequestException as e:
-            if attempt < max_retries - 1:
-                print(f"Request failed, retrying... (attempt {attempt + 1}/{max_retries}): {e}")
-                continue
-            else:
-                raise
-        except (KeyError, ValueError) as e:
-            if attempt < max_retries - 1:
-                print(f"Response parsing failed, retrying... (attempt {attempt + 1}/{max_retries}): {e}")
-                continue
-            else:
-                raise
+    },
+)
 
-
-class TransactionState(TypedDict):
-    input_text: str
-    date: str
-    extracted_data: dict
-    final_result: dict
-    errors: Annotated[list, operator.add]
+# Bounds the completions in flight across all batches, so bursts queue here instead of
+# turning into a storm of 429s from OpenRouter.
+openrouter_semaphore = asyncio.Semaphore(OPENROUTER_MAX_CONCURRENCY)
 
 
-def entity_extractor_node(state: TransactionState) -> TransactionState:
-    """Extract entities from the input text"""
-    input_text = state["input_text"]
-    
-    system_prompt = f"""
-    You are an intelligent financial data extraction assistant. You are skilled in extracting structured financial 
-    transaction data from unstructured text, such as emails or OCR-processed documents.
+# Static prompt text is built once at import. Everything that varies per call (texts, dates, counts)
+# goes at the end of the user message, so every request shares a byte-identical prefix that the
+# provider can serve from its prompt cache. Only the short *_TEMPLATE suffixes go through str.format.
+TRANSACTION_SYSTEM_PROMPT = """
+    You are an intelligent financial data extraction and expense categorization assistant. You are skilled in extracting
+    structured financial transaction data from unstructured text, such as emails or OCR-processed documents,
+    and in classifying transactions into predefined categories.
     """
 
-    user_prompt = f"""
-    Given the following raw text from an email and OCR-processed attachments, extract the following fields accurately as JSON:
-
+# Field definitions and examples shared by the single-email and batched prompts.
+TRANSACTION_FIELDS_PROMPT = """
     - "text": a short description of the transaction
-    - "date": transaction date in YYYY-MM-DD format (Use the email date {state["date"] if state["date"] else "None"} if missing)
+    - "date": transaction date in YYYY-MM-DD format (Use the email date given with the text if missing)
     - "amount": transaction amount as a float (0.00 if missing)
     - "currency": 3-letter ISO currency code (e.g., USD, SGD, if missing, use "None")
     - "vendor": merchant or party involved for transaction with EARLYBIRD AI PTE LTD (if missing, use "None")
@@ -112,145 +75,241 @@ def entity_extractor_node(state: TransactionState) -> TransactionState:
     * "Debit" = Money going OUT of EARLYBIRD AI PTE LTD (expenses, payments made, purchases)
     * "Credit" = Money coming INTO EARLYBIRD AI PTE LTD (income, payments received, refunds)
     - "referenceid": string of unique transaction or invoice identifier (if missing, use "None")
+    - "label": the category of the transaction, chosen from the description, merchant, and amount:
+    * "Meals & Entertainment": Restaurants, bars, catering, team meals, client dinners, entertainment venues (e.g. Starbucks, Blue Bottle Coffee)
+    * "Transport": Uber, taxi, gas, parking, public transit, car rentals, vehicle maintenance (e.g. Uber trip, Shell gas station)
+    * "SaaS": Software subscriptions, cloud services, online tools, digital platforms (e.g. Adobe Creative Cloud, Amazon Web Services, Microsoft Office 365)
+    * "Travel": Hotels, flights, airfare, accommodation, travel booking sites (e.g. Marriott Hotel, United Airlines)
+    * "Office": Office supplies, equipment, furniture, utilities, rent, phone bills (e.g. Staples, Verizon Business)
+    * "Other": Any transaction that doesn't clearly fit the above categories (e.g. Walmart miscellaneous items)
 
     EXAMPLES:
 
     Example 1 - Invoice received (money going out):
     Raw text: "Invoice #INV-2024-001 from Office Supplies Co. for 250.00 EUR dated 2024-03-15. Payment due for office equipment purchase."
-    JSON: {{"text": "Office equipment purchase", "date": "2024-03-15", "amount": 250.00, "currency": "EUR", "vendor": "Office Supplies Co.", "ttype": "Debit", "referenceid": "INV-2024-001"}}
+    JSON: {"text": "Office equipment purchase", "date": "2024-03-15", "amount": 250.00, "currency": "EUR", "vendor": "Office Supplies Co.", "ttype": "Debit", "referenceid": "INV-2024-001", "label": "Office"}
 
     Example 2 - Payment received (money coming in):
     Raw text: "Payment received from Client ABC to EARLYBIRD AI PTE LTD. for services rendered. Amount: SGD 1,500.00. Reference: PAY-2024-445. Date: 2024-03-20"
-    JSON: {{"text": "Payment received for services", "date": "2024-03-20", "amount": 1500.00, "currency": "SGD", "vendor": "Client ABC", "ttype": "Credit", "referenceid": "PAY-2024-445"}}
+    JSON: {"text": "Payment received for services", "date": "2024-03-20", "amount": 1500.00, "currency": "SGD", "vendor": "Client ABC", "ttype": "Credit", "referenceid": "PAY-2024-445", "label": "Other"}
 
     Example 3 - Refund received (money coming in):
     Raw text: "Refund processed by Software Provider Ltd. to EARLYBIRD AI PTE LTD. Amount: USD 89.99. Refund ID: REF-789. Date: 2024-03-18"
-    JSON: {{"text": "Refund from software provider", "date": "2024-03-18", "amount": 89.99, "currency": "USD", "vendor": "Software Provider Ltd.", "ttype": "Credit", "referenceid": "REF-789"}}
+    JSON: {"text": "Refund from software provider", "date": "2024-03-18", "amount": 89.99, "currency": "USD", "vendor": "Software Provider Ltd.", "ttype": "Credit", "referenceid": "REF-789", "label": "SaaS"}
 
     Example 4 - Expense payment (money going out):
     Raw text: "Monthly subscription fee charged by Cloud Services Inc. $45.00 USD. Transaction ID: TXN-456789. Date: 2024-03-25"
-    JSON: {{"text": "Monthly subscription fee", "date": "2024-03-25", "amount": 45.00, "currency": "USD", "vendor": "Cloud Services Inc.", "ttype": "Debit", "referenceid": "TXN-456789"}}
+    JSON: {"text": "Monthly subscription fee", "date": "2024-03-25", "amount": 45.00, "currency": "USD", "vendor": "Cloud Services Inc.", "ttype": "Debit", "referenceid": "TXN-456789", "label": "SaaS"}
+"""
 
+TRANSACTION_USER_PROMPT_PREFIX = """
+    Given the following raw text from an email and OCR-processed attachments, extract the following fields accurately as JSON:
+""" + TRANSACTION_FIELDS_PROMPT + """
     IMPORTANT: Return ONLY the JSON object without any explanation, formatting, or additional text. Do not include any markdown formatting or explanatory text.
+"""
 
-    Raw text from email and OCR attachments:
+TRANSACTION_USER_PROMPT_TEMPLATE = """
+    Raw text from email and OCR attachments (email date {date}):
     \"\"\"
     {input_text}
     \"\"\"
 
     JSON:"""
 
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt}
-    ]
-
-    try:
-        print(f"EntityExtractor: Processing text length: {len(input_text)}")
-        
-        raw_output = call_openrouter(messages)
-        print(f"EntityExtractor: Raw output: {raw_output[:200]}...")
-        
-        extracted_data = json.loads(raw_output)
-        print(f"EntityExtractor: Successfully parsed JSON")
-        
-        return {
-            **state,
-            "extracted_data": extracted_data,
-            "errors": []
-        }
-    except Exception as e:
-        print(f"EntityExtractor: Error occurred: {type(e).__name__}: {str(e)}")
-        default_data = {
-            "text": "Error extracting data",
-            "date": "None",
-            "amount": 0.00,
-            "currency": "None",
-            "vendor": "None",
-            "ttype": "None",
-            "referenceid": "None"
-        }
-        return {
-            **state,
-            "extracted_data": default_data,
-            "errors": [f"EntityExtractor error: {str(e)}"]
-        }
+TRANSACTION_BATCH_PROMPT_PREFIX = """
+    Given the following numbered raw texts, each from an email and its OCR-processed attachments, extract the following fields accurately as JSON for every text:
+""" + TRANSACTION_FIELDS_PROMPT + """
+    Each object must also have a "number" field: the integer number of the text it was extracted from (1 for Text 1, and so on).
+    IMPORTANT: Return ONLY a JSON array with one object per text, in the same order, without any explanation, formatting, or additional text. Do not include any markdown formatting or explanatory text.
+"""
 
+TRANSACTION_BATCH_PROMPT_TEMPLATE = """
+{texts}
+    JSON array of exactly {count} objects:"""
 
-def categorizer_node(state: TransactionState) -> TransactionState:
-    """Categorize the transaction"""
-    input_data = state["extracted_data"]
-    input_text = state["input_text"]
-    
-    system_prompt = f"""
-    You are an expert financial transaction categorization assistant.
-    You are skilled in classifying transactions into predefined categories based on the extracted data.
-    """
-    
-    user_prompt = f"""# Expense Classification Prompt
+TRANSACTION_BATCH_ITEM_TEMPLATE = """    Text {number} (email date {date}):
+    \"\"\"
+    {input_text}
+    \"\"\"
+"""
 
-        You are an expert expense categorization assistant. Your task is to classify transaction data into one of the following categories based on the description, merchant, and amount:
 
-        ## Categories:
-        - **Meals & Entertainment**: Restaurants, bars, catering, team meals, client dinners, entertainment venues
-        - **Transport**: Uber, taxi, gas, parking, public transit, car rentals, vehicle maintenance
-        - **SaaS**: Software subscriptions, cloud services, online tools, digital platforms
-        - **Travel**: Hotels, flights, airfare, accommodation, travel booking sites
-        - **Office**: Office supplies, equipment, furniture, utilities, rent, phone bills
-        - **Other**: Any expense that doesn't clearly fit the above categories
+class JsonSpanScanner:
+    """Find the first balanced top-level JSON span starting with `opening` ("{" for an object,
+    "[" for an array) in text fed piece by piece, ignoring brackets inside JSON strings.
 
-        ## Instructions:
-        1. Analyze the transaction description, merchant name, and amount
-        2. Consider the business context and typical expense patterns
-        3. Choose the most appropriate category
-        4. Return only a JSON object with a "label" field
+    The scan state (depth, string/escape flags, the open span so far) is kept between feeds,
+    so every character is looked at once however the text is split. Handles any nesting depth.
+    """
 
-        ## Examples:
+    def __init__(self, opening="{"):
+        self.opening = opening
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.span = []
+
+    def feed(self, text):
+        """Scan the next piece of text.
+
+        Returns:
+            The parsed value of the first span completed in this piece that parses, or None
+        """
+        start = 0
+        for i, c in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif c == "\\":
+                    self.escaped = True
+                elif c == '"':
+                    self.in_string = False
+            elif c == '"' and self.depth:
+                self.in_string = True
+            elif c == self.opening or (self.depth and c in "{["):
+                if self.depth == 0:
+                    start = i
+                self.depth += 1
+            elif c in "}]" and self.depth:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.span.append(text[start:i + 1])
+                    candidate = "".join(self.span)
+                    self.span = []
+                    try:
+                        return orjson.loads(candidate)
+                    except orjson.JSONDecodeError:
+                        continue
+        if self.depth:
+            self.span.append(text[start:])
+        return None
+
+
+def extract_json_from_text(text, opening="{"):
+    """Extract and parse JSON from text that may contain explanatory content.
+
+    Returns the parsed value of the first balanced top-level span starting with `opening`
+    that parses (see JsonSpanScanner). Linear in the text length.
+    """
+    value = JsonSpanScanner(opening).feed(text)
+    if value is None:
+        raise ValueError("No valid JSON found in response")
+    return value
 
-        **Input:** "UBER TRIP - SAN FRANCISCO, $23.45"
-        **Output:** {{"label": "Transport"}}
 
-        **Input:** "STARBUCKS COFFEE - DOWNTOWN, $8.99"
-        **Output:** {{"label": "Meals & Entertainment"}}
+def _shrink(text: str, head: int = LLM_INPUT_HEAD_CHARS, tail: int = LLM_INPUT_TAIL_CHARS) -> str:
+    """Cut the middle out of an oversized input, keeping the parts the fields are almost always in.
 
-        **Input:** "ADOBE CREATIVE CLOUD SUBSCRIPTION, $52.99"
-        **Output:** {{"label": "SaaS"}}
+    Only the prompt sees the shortened text; fingerprints and cache keys use the full text.
+    """
+    if len(text) <= head + tail:
+        return text
+    return text[:head] + "\n...\n" + text[-tail:]
 
-        **Input:** "MARRIOTT HOTEL - CHICAGO, $189.00"
-        **Output:** {{"label": "Travel"}}
 
-        **Input:** "STAPLES OFFICE SUPPLIES, $45.67"
-        **Output:** {{"label": "Office"}}
+async def stream_completion(payload, opening="{"):
+    """Stream a chat completion, stopping as soon as its content holds a complete JSON value.
 
-        **Input:** "AMAZON WEB SERVICES, $127.83"
-        **Output:** {{"label": "SaaS"}}
+    Whatever the model would have generated after the JSON (explanations, repeats) is never
+    waited for: leaving the stream early closes it, which ends the generation upstream.
+    At most OPENROUTER_MAX_CONCURRENCY completions stream at once; callers wait their turn.
 
-        **Input:** "SHELL GAS STATION, $65.22"
-        **Output:** {{"label": "Transport"}}
+    Returns:
+        (content, value): the content received so far, and the parsed first complete JSON value
+        starting with `opening`, or None if the completion ended without one
+    """
+    content = []
+    scanner = JsonSpanScanner(opening)
+    async with openrouter_semaphore, openrouter_client.stream("POST", OPENROUTER_URL, json=payload) as resp:
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            # Skip blank separators and ": OPENROUTER PROCESSING" keep-alive comments.
+            if not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+            chunk = orjson.loads(data)
+            if "error" in chunk:
+                raise ValueError(f"Error in response stream: {chunk['error']}")
+            if not chunk.get("choices"):
+                continue
+            delta = chunk["choices"][0]["delta"].get("content") or ""
+            content.append(delta)
+            value = scanner.feed(delta)
+            if value is not None:
+                return "".join(content), value
+    return "".join(content), None
 
-        **Input:** "BLUE BOTTLE COFFEE - CLIENT MEETING, $34.50"
-        **Output:** {{"label": "Meals & Entertainment"}}
 
-        **Input:** "UNITED AIRLINES - FLIGHT TO NYC, $456.00"
-        **Output:** {{"label": "Travel"}}
+async def call_openrouter(messages, max_retries=3, opening="{", max_tokens=MAX_TOKENS_PER_RESULT):
+    payload = {
+        "model": MODEL_NAME,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": 0.1,
+        "stream": True,
+    }
+    # JSON mode only constrains output to an object; array responses rely on the prompt
+    # and extract_json_from_text, which stays as the fallback for objects too.
+    if opening == "{":
+        payload["response_format"] = {"type": "json_object"}
+    
+    for attempt in range(max_retries):
+        try:
+            content, value = await stream_completion(payload, opening)
+            if value is not None:
+                return value
+            
+            if not content or not content.strip():
+                raise ValueError("Empty response content")
+            
+            content = FENCE_RE.sub("", content.strip())
+            
+            try:
+                return extract_json_from_text(content, opening)
+            except ValueError:
+                if attempt < max_retries - 1:
+                    logger.warning("JSON extraction failed, retrying... (attempt %d/%d)", attempt + 1, max_retries)
+                    logger.debug("Content received: %.500s...", content)
+                    continue
+                else:
+                    raise ValueError(f"Invalid JSON after {max_retries} attempts: {content}")
+            
+        except httpx.HTTPError as e:
+            if attempt < max_retries - 1:
+                logger.warning("Request failed, retrying... (attempt %d/%d): %s", attempt + 1, max_retries, e)
+                continue
+            else:
+                raise
+        except (KeyError, ValueError) as e:
+            if attempt < max_retries - 1:
+                logger.warning("Response parsing failed, retrying... (attempt %d/%d): %s", attempt + 1, max_retries, e)
+                continue
+            else:
+                raise
 
-        **Input:** "VERIZON BUSINESS - OFFICE PHONE, $89.99"
-        **Output:** {{"label": "Office"}}
 
-        **Input:** "MICROSOFT OFFICE 365, $15.00"
-        **Output:** {{"label": "SaaS"}}
+class TransactionState(TypedDict):
+    input_text: str
+    date: str
+    final_result: dict
+    errors: Annotated[list, operator.add]
 
-        **Input:** "WALMART - MISCELLANEOUS ITEMS, $23.45"
-        **Output:** {{"label": "Other"}}
 
-        ## Task:
-        Classify the following transaction data:
+async def transaction_extractor_node(state: TransactionState) -> dict:
+    """Extract the transaction fields and its category label from the input text in one LLM call.
 
-        ```
-        {input_text}
-        ```
+    Returns only the keys it updates; LangGraph merges them into the state, so the
+    (possibly large) input text is never copied.
+    """
+    input_text = state["input_text"]
+    
+    system_prompt = TRANSACTION_SYSTEM_PROMPT
 
-        Return only a JSON object with a "label" field containing the category."""
+    user_prompt = TRANSACTION_USER_PROMPT_PREFIX + TRANSACTION_USER_PROMPT_TEMPLATE.format(
+        date=state["date"] or "None", input_text=_shrink(input_text)
+    )
 
     messages = [
         {"role": "system", "content": system_prompt},
@@ -258,52 +317,88 @@ def categorizer_node(state: TransactionState) -> TransactionState:
     ]
 
     try:
-        print(f"Categorizer: Processing data: {json.dumps(input_data, indent=2)}")
+        logger.debug("TransactionExtractor: Processing text length: %d", len(input_text))
         
-        raw_output = call_openrouter(messages)
-        print(f"Categorizer: Raw output: {raw_output[:200]}...")
+        final_result = await call_openrouter(messages)
+        logger.debug("TransactionExtractor: Parsed output: %.200s...", final_result)
         
-        category_result = json.loads(raw_output)
-        print(f"Categorizer: Successfully parsed JSON")
-        
-        final_result = {
-            **input_data,
-            "label": category_result.get("label", "Other")
-        }
+        final_result.setdefault("label", "Other")
+        logger.debug("TransactionExtractor: Successfully parsed JSON")
         
         return {
-            **state,
-            "final_result": final_result
+            "final_result": final_result,
+            "errors": []
         }
     except Exception as e:
-        print(f"Categorizer: Error occurred: {type(e).__name__}: {str(e)}")
-        final_result = {
-            **input_data,
+        logger.error("TransactionExtractor: Error occurred: %s: %s", type(e).__name__, e)
+        default_data = {
+            "text": "Error extracting data",
+            "date": "None",
+            "amount": 0.00,
+            "currency": "None",
+            "vendor": "None",
+            "ttype": "None",
+            "referenceid": "None",
             "label": "Other"
         }
         return {
-            **state,
-            "final_result": final_result,
-            "errors": state.get("errors", []) + [f"Categorizer error: {str(e)}"]
+            "final_result": default_data,
+            "errors": [f"TransactionExtractor error: {str(e)}"]
         }
 
 def create_workflow():
+    # A single node: extraction and categorization share one LLM call. Kept as a graph
+    # so the steps can be split into separate nodes again if categorization quality needs it.
     workflow = StateGraph(TransactionState)
     
-    workflow.add_node("extract_entities", entity_extractor_node)
-    workflow.add_node("categorize", categorizer_node)
+    workflow.add_node("extract_transaction", transaction_extractor_node)
 
-    workflow.add_edge("extract_entities", "categorize")
-    workflow.add_edge("categorize", END)
+    workflow.add_edge("extract_transaction", END)
     
-    workflow.set_entry_point("extract_entities")
+    workflow.set_entry_point("extract_transaction")
     
     return workflow.compile()
 
 transaction_workflow = create_workflow()
 
 
-def classify_email_agentic(raw_text: str, date: str = None) -> dict:
+def _unconfigured_result() -> dict:
+    logger.warning("OPENROUTER_API_KEY environment variable is not set")
+    return {
+        "text": "API key not configured",
+        "date": "None",
+        "amount": 0.00,
+        "currency": "None",
+        "vendor": "None",
+        "ttype": "None",
+        "referenceid": "None",
+        "label": "Other"
+    }
+
+
+def _no_transaction_result(date: str = None) -> dict:
+    return {
+        "text": "No transaction found",
+        "date": date or "None",
+        "amount": 0.00,
+        "currency": "None",
+        "vendor": "None",
+        "ttype": "None",
+        "referenceid": "None",
+        "label": "Other"
+    }
+
+
+def _initial_state(raw_text: str, date: str = None) -> TransactionState:
+    return {
+        "input_text": raw_text,
+        "date": date,
+        "final_result": {},
+        "errors": []
+    }
+
+
+async def classify_email_agentic(raw_text: str, date: str = None) -> dict:
     """
     Process raw email text through the LangGraph workflow to extract and classify transaction data.
     
@@ -315,37 +410,184 @@ def classify_email_agentic(raw_text: str, date: str = None) -> dict:
         Dictionary containing extracted and classified transaction data
     """
     if not OPENROUTER_API_KEY:
-        print("Warning: OPENROUTER_API_KEY environment variable is not set")
-        return {
-            "text": "API key not configured",
-            "date": "None",
-            "amount": 0.00,
-            "currency": "None",
-            "vendor": "None",
-            "ttype": "None",
-            "referenceid": "None",
-            "label": "Other"
-        }
+        return _unconfigured_result()
     
-    initial_state = {
-        "input_text": raw_text,
-        "date": date,
-        "extracted_data": {},
-        "final_result": {},
-        "errors": []
-    }
-    
-    print(f"Starting workflow with input text: {raw_text[:100]}...")
-    result = transaction_workflow.invoke(initial_state)
+    logger.debug("Starting workflow with input text: %.100s...", raw_text)
+    result = await transaction_workflow.ainvoke(_initial_state(raw_text, date))
     
     if result.get("errors"):
-        print("Workflow errors:", result["errors"])
+        logger.warning("Workflow errors: %s", result["errors"])
     
     return result["final_result"]
 
 
+async def classify_in_one_prompt(raw_texts: list[str], dates: list[str]) -> list[dict]:
+    """
+    Classify several emails with a single LLM request that returns one JSON object per email,
+    so the instructions and examples are sent (and billed) once for the whole batch.
+
+    Args:
+        raw_texts: Raw email/document texts
+        dates: Email dates, one per text
+
+    Returns:
+        The classified transaction dictionaries, in input order
+
+    Raises:
+        ValueError: If the response is not an array of exactly one object per input, each carrying
+            the number of its text in input order; the caller then classifies the texts one by one
+    """
+    texts = "\n".join(
+        TRANSACTION_BATCH_ITEM_TEMPLATE.format(number=i + 1, date=date or "None", input_text=_shrink(raw_text))
+        for i, (raw_text, date) in enumerate(zip(raw_texts, dates))
+    )
+    user_prompt = TRANSACTION_BATCH_PROMPT_PREFIX + TRANSACTION_BATCH_PROMPT_TEMPLATE.format(
+        count=len(raw_texts), texts=texts
+    )
+    messages = [
+        {"role": "system", "content": TRANSACTION_SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt}
+    ]
+
+    logger.debug("BatchExtractor: Processing %d texts in one prompt", len(raw_texts))
+    results = await call_openrouter(messages, opening="[", max_tokens=MAX_TOKENS_PER_RESULT * len(raw_texts))
+    if not isinstance(results, list) or len(results) != len(raw_texts) or not all(isinstance(r, dict) for r in results):
+        raise ValueError(f"Expected a JSON array of {len(raw_texts)} objects")
+    # A length match alone would not catch reordered, merged or split objects, which would
+    # attach one email's transaction to another email's fingerprint.
+    numbers = [result.pop("number", None) for result in results]
+    if numbers != list(range(1, len(raw_texts) + 1)):
+        raise ValueError(f"Expected objects numbered 1 to {len(raw_texts)} in order, got {numbers}")
+
+    for result in results:
+        result.setdefault("label", "Other")
+    return results
+
+
+def classify_cache_key(raw_text: str, date: str = None) -> str:
+    """
+    Redis key for a cached classification of this text and date under the current model.
+    """
+    digest = xxhash.xxh3_128(MODEL_NAME.encode())
+    for part in (raw_text, date or ""):
+        digest.update(b"\x1f")
+        digest.update(part.encode())
+    return f"classify:v2:{digest.hexdigest()}"
+
+
+async def classify_uncached(raw_texts: list[str], dates: list[str]) -> tuple[list, list[bool]]:
+    """
+    Classify several emails with the LLM: first as a single batched prompt, and if that
+    response is unusable, with one workflow batch call whose invocations run concurrently.
+
+    Args:
+        raw_texts: Raw email/document texts
+        dates: Email dates, one per text
+
+    Returns:
+        One entry per input, in order (the classified transaction dictionary, or the
+        exception raised while classifying that input), and for each entry whether
+        it is a clean result that may be cached
+    """
+    if len(raw_texts) > 1:
+        try:
+            results = await classify_in_one_prompt(raw_texts, dates)
+            return results, [True] * len(results)
+        except Exception as e:
+            logger.warning("Batched prompt failed, classifying individually: %s: %s", type(e).__name__, e)
+
+    logger.debug("Starting workflow batch of %d texts", len(raw_texts))
+    states = [_initial_state(raw_text, date) for raw_text, date in zip(raw_texts, dates)]
+    results = await transaction_workflow.abatch(states, return_exceptions=True)
+
+    outputs = []
+    cacheable = []
+    for result in results:
+        if isinstance(result, Exception):
+            outputs.append(result)
+            cacheable.append(False)
+            continue
+        if result.get("errors"):
+            logger.warning("Workflow errors: %s", result["errors"])
+        outputs.append(result["final_result"])
+        cacheable.append(not result.get("errors"))
+    return outputs, cacheable
+
+
+async def classify_email_batch(raw_texts: list[str], dates: list[str], validate=None) -> list:
+    """
+    Classify several emails together. Texts with nothing a transaction could be read from
+    (no TRANSACTION_HINT_RE match) get a "No transaction found" result straight away.
+    Texts classified before (same text and date) are answered from the in-process cache,
+    then from the Redis cache; only the rest go to the LLM, and their clean results are
+    cached for CLASSIFY_CACHE_TTL_SECONDS once they pass `validate`. Cached results were
+    validated when stored, so `validate` runs once per result.
+
+    Args:
+        raw_texts: Raw email/document texts
+        dates: Email dates, one per text
+        validate: Optional function run on each result not answered from the cache; it returns
+            the result to use (and cache), or raises if the result is unusable, and that input
+            then gets the exception and nothing is cached
+
+    Returns:
+        One entry per input, in order: the classified transaction dictionary,
+        or the exception raised while classifying that input
+    """
+    def checked(i: int, result):
+        if validate is None or isinstance(result, Exception):
+            return result
+        try:
+            return validate(result)
+        except Exception as e:
+            logger.warning("Invalid classification result for text %d/%d: %s", i + 1, len(raw_texts), e)
+            return e
+
+    if not OPENROUTER_API_KEY:
+        return [checked(i, _unconfigured_result()) for i in range(len(raw_texts))]
+
+    keys = [classify_cache_key(raw_text, date) for raw_text, date in zip(raw_texts, dates)]
+    cached = [classify_local_cache.get(key) for key in keys]
+    unhinted = [i for i, raw_text in enumerate(raw_texts) if cached[i] is None and not TRANSACTION_HINT_RE.search(raw_text)]
+    for i in unhinted:
+        logger.info("No transaction hints in text %d/%d, skipping the LLM", i + 1, len(raw_texts))
+        cached[i] = orjson.dumps(_no_transaction_result(dates[i]))
+    remote = [i for i, value in enumerate(cached) if value is None]
+    if remote:
+        for i, value in zip(remote, await async_redis_conn.mget([keys[i] for i in remote])):
+            if value is not None:
+                classify_local_cache[keys[i]] = value
+                cached[i] = value
+
+    outputs = [orjson.loads(value) if value is not None else None for value in cached]
+    for i in unhinted:
+        outputs[i] = checked(i, outputs[i])
+    misses = [i for i, output in enumerate(outputs) if output is None]
+    if len(misses) < len(outputs):
+        logger.debug("Answered without the LLM: %d/%d", len(outputs) - len(misses), len(outputs))
+    if not misses:
+        return outputs
+
+    results, cacheable = await classify_uncached([raw_texts[i] for i in misses], [dates[i] for i in misses])
+    fresh = {}
+    for i, result, ok in zip(misses, results, cacheable):
+        result = checked(i, result)
+        ok = ok and not isinstance(result, Exception)
+        outputs[i] = result
+        if ok:
+            fresh[keys[i]] = orjson.dumps(result)
+
+    if fresh:
+        classify_local_cache.update(fresh)
+        async with async_redis_conn.pipeline(transaction=False) as pipe:
+            for key, value in fresh.items():
+                pipe.set(key, value, ex=CLASSIFY_CACHE_TTL_SECONDS)
+            await pipe.execute()
+    return outputs
+
+
 if __name__ == "__main__":
     # Test with sample data
     sample_email_text = "Your invoice from ACME Corp on 2025-07-05 for USD 123.45. Transaction ID 98765."
-    result = classify_email_agentic(sample_email_text, "2025-07-05")
-    print("Final classified output:", json.dumps(result, indent=2))
\ No newline at end of file
+    result = asyncio.run(classify_email_agentic(sample_email_text, "2025-07-05"))
+    print("Final classified output:", orjson.dumps(result, option=orjson.OPT_INDENT_2).decode())
\ No newline at end of file
@@ -0,0 +1,232 @@
+import os
+import math
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+
+from .redis_publisher import redis_conn
+
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "3"))
+OCR_ZOOM = 2
+OCR_MAX_PIXELS = 4_000_000  # Larger regions are rendered at a lower zoom to bound pixmap memory
+OCR_PAGE_CACHE_TTL_SECONDS = 30 * 86400
+OCR_MIN_IMAGE_COVERAGE = 0.5  # Below this share of the page, images are logos/stamps beside vector text
+
+def create_ocr_pool() -> ProcessPoolExecutor:
+    """
+    Create the process pool that runs all PyMuPDF/Tesseract work, never the API process itself:
+    PyMuPDF is not thread-safe, and OCR would otherwise compete with request handling for the
+    worker's CPU and GIL. Processes are spawned (not forked) so they never inherit the API's
+    threads or open Redis/DB sockets. The API creates one in its lifespan (app.state.ocr_pool).
+    """
+    return ProcessPoolExecutor(max_workers=OCR_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+@lru_cache(maxsize=1)
+def _tessdata() -> str:
+    """
+    Locate the Tesseract language data once per process. Left to itself, every
+    get_textpage_ocr() call re-resolves it, shelling out to `tesseract --list-langs`
+    when TESSDATA_PREFIX is unset.
+    """
+    return fitz.get_tessdata()
+
+def _ocr_pixmap(pix, ocr_doc) -> str:
+    """
+    Run Tesseract (through MuPDF) over a rendered pixmap.
+
+    Args:
+        pix (fitz.Pixmap): The image to recognize.
+        ocr_doc (fitz.Document): Scratch document to place the image in; reused across
+            calls, its previous page is replaced.
+    Returns:
+        str: The recognized text.
+    """
+    if ocr_doc.page_count:
+        ocr_doc.delete_page(0)
+    ocr_page = ocr_doc.new_page(width=pix.width, height=pix.height)
+    ocr_page.insert_image(fitz.Rect(0, 0, pix.width, pix.height), pixmap=pix)
+    tp = ocr_page.get_textpage_ocr(tessdata=_tessdata())
+    return ocr_page.get_text("text", textpage=tp)
+
+def _ocr_page_cached(pix, ocr_doc) -> str:
+    """
+    OCR a rendered page, reusing the text of any identical page image seen before
+    (repeated letterheads, template pages, the same scan in several emails).
+    The cache is best-effort: if Redis is unavailable the page is simply OCR'd.
+
+    Args:
+        pix (fitz.Pixmap): The rendered page.
+        ocr_doc (fitz.Document): Scratch document for _ocr_pixmap.
+    Returns:
+        str: The recognized text.
+    """
+    digest = hashlib.blake2b(f"{pix.width}x{pix.height}x{pix.n}".encode(), digest_size=16)
+    digest.update(pix.samples_mv)
+    page_key = f"ocr:page:{digest.hexdigest()}"
+
+    try:
+        cached = redis_conn.get(page_key)
+        if cached is not None:
+            return cached.decode()
+    except Exception as e:
+        logging.warning(f"OCR page cache lookup failed: {e}")
+
+    text = _ocr_pixmap(pix, ocr_doc)
+    try:
+        redis_conn.set(page_key, text, ex=OCR_PAGE_CACHE_TTL_SECONDS)
+    except Exception as e:
+        logging.warning(f"Failed to cache OCR page text: {e}")
+    return text
+
+def _ocr_regions(page) -> list:
+    """
+    Areas of a page without a text layer worth rendering for OCR: the placed images,
+    in reading order, when they cover most of the page (a scan). Otherwise the whole page,
+    since the text is vector-drawn and the images are at most logos or stamps beside it.
+
+    Args:
+        page (fitz.Page): The page to inspect.
+    Returns:
+        list[fitz.Rect]: The clip rectangles to OCR.
+    """
+    rects = [fitz.Rect(info["bbox"]) & page.rect for info in page.get_image_info()]
+    rects = sorted((r for r in rects if not r.is_empty), key=lambda r: (r.y0, r.x0))
+    page_area = page.rect.width * page.rect.height
+    if sum(r.width * r.height for r in rects) < OCR_MIN_IMAGE_COVERAGE * page_area:
+        return [page.rect]
+    return rects
+
+def _render_region(page, rect):
+    """
+    Render one region of a page as a grayscale pixmap (OCR only needs luminance, a third
+    the size of RGB), at OCR_ZOOM or less so the pixmap never exceeds OCR_MAX_PIXELS.
+
+    Args:
+        page (fitz.Page): The page to render.
+        rect (fitz.Rect): The region of the page to render.
+    Returns:
+        fitz.Pixmap: The rendered region.
+    """
+    zoom = min(OCR_ZOOM, math.sqrt(OCR_MAX_PIXELS / max(rect.width * rect.height, 1)))
+    return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=rect, colorspace=fitz.csGRAY, alpha=False)
+
+def _ocr_pdf_pages(pdf_bytes: bytes, page_numbers: list[int]) -> list[tuple[int, str]]:
+    """
+    Render and OCR the given pages of a PDF. Runs in an OCR pool worker,
+    which opens its own copy of the document. On scanned pages only the image regions
+    are rendered, so whitespace margins are never sent through Tesseract; if they yield
+    no text, the whole page is OCR'd instead.
+
+    Args:
+        pdf_bytes (bytes): The content of the PDF.
+        page_numbers (list[int]): Zero-based indices of the pages to OCR.
+    Returns:
+        list[tuple[int, str]]: (page index, text) for each requested page.
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    # One scratch document for every region OCR'd in this call, closed with the source document.
+    ocr_doc = fitz.open()
+    try:
+        results = []
+        for n in page_numbers:
+            page = doc.load_page(n)
+            texts = []
+            # One region pixmap alive at a time, whatever the page count.
+            regions = _ocr_regions(page)
+            for rect in regions:
+                pix = _render_region(page, rect)
+                texts.append(_ocr_page_cached(pix, ocr_doc))
+                pix = None
+            if regions != [page.rect] and not any(text.strip() for text in texts):
+                pix = _render_region(page, page.rect)
+                texts = [_ocr_page_cached(pix, ocr_doc)]
+                pix = None
+            results.append((n, "\n".join(texts)))
+        return results
+    finally:
+        ocr_doc.close()
+        doc.close()
+
+def _pdf_text_layer(file_bytes: bytes) -> list[str]:
+    """
+    Read the embedded text of every PDF page. Runs in an OCR pool worker.
+
+    Args:
+        file_bytes (bytes): The content of the PDF.
+    Returns:
+        list[str]: The stripped text of each page; empty for pages that need OCR.
+    """
+    doc = fitz.open(stream=file_bytes, filetype="pdf")
+    try:
+        return [page.get_text().strip() for page in doc]
+    finally:
+        doc.close()
+
+def _ocr_image_file(file_bytes: bytes) -> str:
+    """
+    OCR a single image file as a grayscale pixmap. Runs in an OCR pool worker.
+    """
+    img = fitz.Pixmap(file_bytes)
+    if img.alpha:
+        img = fitz.Pixmap(img, 0)
+    if img.n != 1:
+        img = fitz.Pixmap(fitz.csGRAY, img)
+    ocr_doc = fitz.open()
+    try:
+        return _ocr_pixmap(img, ocr_doc)
+    finally:
+        ocr_doc.close()
+
+async def _ocr_pdf(pool: ProcessPoolExecutor, file_bytes: bytes) -> str:
+    """
+    Extract the text of a PDF, page by page. Pages without a text layer are split
+    across up to OCR_WORKERS processes.
+    """
+    loop = asyncio.get_running_loop()
+    texts = await loop.run_in_executor(pool, _pdf_text_layer, file_bytes)
+
+    scanned = [n for n, text in enumerate(texts) if not text]
+    if scanned:
+        workers = min(len(scanned), OCR_WORKERS)
+        chunks = await asyncio.gather(*(
+            loop.run_in_executor(pool, _ocr_pdf_pages, file_bytes, scanned[i::workers]) for i in range(workers)
+        ))
+        for chunk in chunks:
+            for n, text in chunk:
+                texts[n] = text
+
+    return "".join(f"\n\n--- Page {n + 1} ---\n\n{text}" for n, text in enumerate(texts))
+
+async def _ocr_image(pool: ProcessPoolExecutor, file_bytes: bytes) -> str:
+    return await asyncio.get_running_loop().run_in_executor(pool, _ocr_image_file, file_bytes)
+
+# Lower-cased file extension -> OCR handler.
+OCR_HANDLERS = {
+    ".pdf": _ocr_pdf,
+    ".png": _ocr_image,
+    ".jpg": _ocr_image,
+    ".jpeg": _ocr_image,
+}
+
+async def perform_ocr(pool: ProcessPoolExecutor, file_bytes: bytes, filename: str) -> str:
+    """
+    Function to perform OCR on a document or image file.
+    Uses PyMuPDF (fitz) in the processes of `pool` to extract text from PDF or image files, opened directly from memory.
+    Supports both PDF and common image formats (PNG, JPG, JPEG), dispatched on the file extension.
+
+    Args:
+        pool (ProcessPoolExecutor): The OCR process pool, from create_ocr_pool().
+        file_bytes (bytes): The content of the file to process.
+        filename (str): The name of the file, used to determine its type.
+    Returns:
+        str: The extracted text from the document or image.
+    """
+    handler = OCR_HANDLERS.get(os.path.splitext(filename)[1].lower())
+    if handler is None:
+        raise ValueError("Unsupported file type")
+    return (await handler(pool, file_bytes)).strip()
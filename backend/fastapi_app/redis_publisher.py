@@ -1,13 +1,59 @@
 import redis
-import re
+import redis.asyncio
 import os
-import json
+import orjson
 import hashlib
+import queue
+import atexit
 import logging
+import logging.handlers
 
 redis_conn = redis.Redis(host=os.getenv("REDIS_HOST", "localhost"), port=6379, db=0)
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "32"))
+REDIS_POOL_TIMEOUT_SECONDS = 10
 
-def publish_entry_once(data):
+# Shared by every coroutine in the process; callers wait for a free connection instead of opening more,
+# and fail after REDIS_POOL_TIMEOUT_SECONDS rather than waiting forever. Only short commands use it.
+async_redis_conn = redis.asyncio.Redis(connection_pool=redis.asyncio.BlockingConnectionPool(
+    host=os.getenv("REDIS_HOST", "localhost"), port=6379, db=0,
+    max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT_SECONDS,
+))
+
+# Pub/sub subscriptions hold their connection for as long as they wait (e.g. a whole OCR job),
+# so they get their own client and can never starve the command pool above.
+async_redis_pubsub_conn = redis.asyncio.Redis(host=os.getenv("REDIS_HOST", "localhost"), port=6379, db=0)
+
+CLAIM_TTL_SECONDS = 600
+CACHE_TTL_SECONDS = 7 * 86400
+
+# Return the cached OCR text if present, otherwise try to claim the OCR job; one atomic round-trip.
+# KEYS: ocr:claim:<fp>, ocr:text:<fp>. ARGV: claim TTL in seconds. Returns {claimed, cached_text}.
+CLAIM_OCR_LUA = """
+local cached = redis.call('GET', KEYS[2])
+if cached then
+    return {0, cached}
+end
+if redis.call('SET', KEYS[1], 'claimed', 'NX', 'EX', ARGV[1]) then
+    return {1, ''}
+end
+return {0, ''}
+"""
+async_claim_script = async_redis_conn.register_script(CLAIM_OCR_LUA)
+
+PUBLISHED_TTL_SECONDS = 3600
+
+# Mark the fingerprint as published and publish the entry, only if it was not marked yet; one round-trip.
+# KEYS: published:<fp>. ARGV: marker TTL in seconds, channel, message. Returns 1 if published, else 0.
+PUBLISH_ONCE_LUA = """
+if redis.call('SET', KEYS[1], '1', 'NX', 'EX', ARGV[1]) then
+    redis.call('PUBLISH', ARGV[2], ARGV[3])
+    return 1
+end
+return 0
+"""
+async_publish_once_script = async_redis_conn.register_script(PUBLISH_ONCE_LUA)
+
+async def publish_entry_once(data):
     """
     Publish to Redis only if this fingerprint has not been published yet.
     """
@@ -17,9 +63,11 @@ def publish_entry_once(data):
         return
 
     redis_key = f"published:{fingerprint}"
+    published = await async_publish_once_script(
+        keys=[redis_key], args=[PUBLISHED_TTL_SECONDS, "ledger_updates", orjson.dumps(data)]
+    )
 
-    if redis_conn.set(redis_key, "1", nx=True, ex=3600):
-        redis_conn.publish("ledger_updates", json.dumps(data))
+    if published:
         logging.info(f"Published new ledger update for {fingerprint[:8]}")
     else:
         logging.info(f"Skipped duplicate publish for {fingerprint[:8]}")
@@ -33,9 +81,29 @@ def normalize_text(text):
     Returns:
         str: The normalized text, stripped of leading/trailing whitespace and converted to lowercase.
     """
-    return re.sub(r"\s+", " ", text.strip().lower())
+    return " ".join(text.lower().split())
 
 class RedisLogHandler(logging.Handler):
     def emit(self, record):
         log_entry = self.format(record)
-        redis_conn.publish("log_stream", json.dumps({"log": log_entry}))
\ No newline at end of file
+        redis_conn.publish("log_stream", orjson.dumps({"log": log_entry}))
+
+# Records queued by every create_log_handler() handler in this process, published by log_listener's thread.
+LOG_QUEUE = queue.SimpleQueue()
+log_listener: logging.handlers.QueueListener | None = None
+
+def create_log_handler() -> logging.Handler:
+    """
+    Create a handler that sends records to the Redis "log_stream" channel without blocking the
+    logging call: records are formatted and queued, and a single background thread per process
+    publishes them through RedisLogHandler.
+
+    Returns:
+        logging.Handler: A QueueHandler feeding LOG_QUEUE; set the formatter on it.
+    """
+    global log_listener
+    if log_listener is None:
+        log_listener = logging.handlers.QueueListener(LOG_QUEUE, RedisLogHandler())
+        log_listener.start()
+        atexit.register(log_listener.stop)
+    return logging.handlers.QueueHandler(LOG_QUEUE)
@@ -0,0 +1,12 @@
+"""
+One-shot schema setup for the ledger database.
+
+Usage (inside the backend container):
+    python scripts/init_db.py
+"""
+import asyncio
+
+from fastapi_app.db import init_db
+
+if __name__ == "__main__":
+    asyncio.run(init_db())
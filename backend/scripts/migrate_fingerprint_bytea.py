@@ -0,0 +1,29 @@
+"""
+One-shot migration for ledger tables created before fingerprints were stored as bytea:
+converts the hex text column to 32 raw bytes. Safe to run more than once.
+
+Usage (inside the backend container):
+    python scripts/migrate_fingerprint_bytea.py
+"""
+import asyncio
+
+from sqlalchemy import text
+
+from fastapi_app.db import engine
+
+async def migrate() -> None:
+    async with engine.begin() as conn:
+        data_type = (await conn.execute(text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_name = 'ledger' AND column_name = 'fingerprint'"
+        ))).scalar()
+        if data_type is None or data_type == "bytea":
+            print(f"Nothing to migrate (fingerprint column type: {data_type})")
+            return
+        await conn.execute(text(
+            "ALTER TABLE ledger ALTER COLUMN fingerprint TYPE bytea USING decode(fingerprint, 'hex')"
+        ))
+        print("ledger.fingerprint converted to bytea")
+
+if __name__ == "__main__":
+    asyncio.run(migrate())